@@ -0,0 +1,88 @@
+import asyncio
+from typing import Awaitable, Callable
+
+from loguru import logger
+from telethon.tl.custom.message import Message
+
+from .metrics import metrics
+
+# Telegram не позволяет отправить в одной медиагруппе больше 10 файлов
+MAX_ALBUM_SIZE = 10
+
+
+class _PendingAlbum:
+    def __init__(self, now):
+        self.messages: dict[int, Message] = {}
+        self.first_seen = now
+        self.last_seen = now
+        self.timer: asyncio.TimerHandle | None = None
+
+
+class AlbumCollector:
+    """Сборка медиагрупп из событий NewMessage без повторного запроса истории.
+
+    Сообщения копятся по grouped_id. Группа отдается на обработку сразу,
+    как только в ней 10 сообщений, или когда после последнего сообщения
+    прошло окно ожидания. Окно подстраивается под наблюдаемые интервалы
+    между сообщениями одной группы и ограничено min_window..max_window.
+    """
+
+    def __init__(
+        self,
+        on_album: Callable[[list[Message], int], Awaitable[None]],
+        min_window=0.3,
+        max_window=3.0,
+    ):
+        self.on_album = on_album
+        self.min_window = min_window
+        self.max_window = max_window
+        # Скользящая оценка интервала между сообщениями одной группы
+        self._gap_estimate = min_window / 3
+        self._albums: dict[int, _PendingAlbum] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def window(self):
+        return min(
+            self.max_window, max(self.min_window, self._gap_estimate * 3)
+        )
+
+    def add(self, message: Message):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        album = self._albums.get(message.grouped_id)
+        if album is None:
+            album = self._albums[message.grouped_id] = _PendingAlbum(now)
+        else:
+            gap = now - album.last_seen
+            self._gap_estimate = 0.8 * self._gap_estimate + 0.2 * gap
+            album.last_seen = now
+
+        album.messages[message.id] = message
+        if album.timer is not None:
+            album.timer.cancel()
+
+        if len(album.messages) >= MAX_ALBUM_SIZE:
+            self._flush(message.grouped_id)
+        else:
+            album.timer = loop.call_later(
+                self.window, self._flush, message.grouped_id
+            )
+
+    def _flush(self, grouped_id):
+        album = self._albums.pop(grouped_id, None)
+        if album is None:
+            return
+        if album.timer is not None:
+            album.timer.cancel()
+        metrics.observe(
+            "album_aggregation",
+            asyncio.get_running_loop().time() - album.first_seen,
+        )
+        media_group = sorted(album.messages.values(), key=lambda x: x.id)
+        logger.info(
+            f"Собрано {len(media_group)} сообщений для медиагруппы {grouped_id}: {[msg.id for msg in media_group]}"
+        )
+        task = asyncio.create_task(self.on_album(media_group, grouped_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
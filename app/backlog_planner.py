@@ -0,0 +1,182 @@
+import heapq
+from dataclasses import dataclass, field
+
+from loguru import logger
+from telethon.tl.custom.message import Message
+from telethon.tl.types import MessageMediaDocument, MessageMediaPhoto
+
+from .config import Config
+from .database import Database
+from .media_processor import MediaProcessor, media_key
+from .work_unit import WorkUnit, message_size
+
+# Сколько самых больших файлов показывать в плане
+LARGEST_FILES = 10
+MEDIA_TYPE_LABELS = {
+    "photo": "фото",
+    "video": "видео",
+    "audio": "аудио",
+    "image": "изображения файлом",
+    "document": "документы",
+}
+
+
+def media_type(message: Message):
+    """Тип медиа для статистики: фото или тип документа по MIME"""
+    if isinstance(message.media, MessageMediaPhoto):
+        return "photo"
+    mime_type = getattr(message.file, "mime_type", None) or ""
+    for prefix in ("video", "audio", "image"):
+        if mime_type.startswith(f"{prefix}/"):
+            return prefix
+    return "document"
+
+
+def format_size(size):
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ТБ"
+
+
+def format_duration(seconds):
+    if seconds < 60:
+        return f"{max(1, round(seconds))} с"
+    minutes = round(seconds / 60)
+    if minutes < 60:
+        return f"{minutes} мин"
+    return f"{minutes // 60} ч {minutes % 60:02d} мин"
+
+
+@dataclass
+class SourcePlan:
+    """Что предстоит перезалить из одного источника"""
+
+    source_chat_id: int
+    singles: int = 0
+    albums: int = 0
+    messages: int = 0
+    count_by_type: dict[str, int] = field(default_factory=dict)
+    bytes_by_type: dict[str, int] = field(default_factory=dict)
+    # Куча (размер, ID сообщения, имя файла) самых больших файлов
+    largest: list[tuple[int, int, str]] = field(default_factory=list)
+    # Репосты и файлы, уже лежащие в группе назначения: уйдут из кэша медиа
+    duplicates: int = 0
+    duplicate_bytes: int = 0
+    # Сколько можно не передавать в режиме reference и сколько сообщений
+    # защищено от пересылки
+    reference_bytes: int = 0
+    protected: int = 0
+
+    @property
+    def total_bytes(self):
+        return sum(self.bytes_by_type.values())
+
+
+class BacklogPlanner:
+    """Статистика пробного прогона бэклога по метаданным сообщений.
+
+    Единицы работы из скана только учитываются: ничего не скачивается и
+    не отправляется. Повторы медиа считаются так же, как их найдет кэш
+    медиа по первой группе назначения маршрута. Оценка времени берется
+    из истории скорости прошлых прогонов в Database: по сообщениям и по
+    байтам отдельно, в ответ идет большая из двух.
+    """
+
+    def __init__(
+        self, media_processor: MediaProcessor, db: Database, config: Config
+    ):
+        self.media_processor = media_processor
+        self.db = db
+        self.config = config
+        self.plans: dict[int, SourcePlan] = {}
+        self._seen: dict[int, set[str]] = {}
+
+    def add(self, unit: WorkUnit):
+        source_chat_id = unit.source_chat_id
+        plan = self.plans.get(source_chat_id)
+        if plan is None:
+            plan = self.plans[source_chat_id] = SourcePlan(source_chat_id)
+        if unit.grouped_id:
+            plan.albums += 1
+        else:
+            plan.singles += 1
+        dest_chat_id = self.config.routes[source_chat_id][0]
+        seen = self._seen.setdefault(dest_chat_id, set())
+        for message in unit.messages:
+            self._add_message(plan, message, dest_chat_id, seen)
+
+    def _add_message(self, plan: SourcePlan, message: Message, dest_chat_id, seen):
+        size = message_size(message)
+        kind = media_type(message)
+        plan.messages += 1
+        plan.count_by_type[kind] = plan.count_by_type.get(kind, 0) + 1
+        plan.bytes_by_type[kind] = plan.bytes_by_type.get(kind, 0) + size
+        item = (size, message.id, self.media_processor.get_file_name(message))
+        if len(plan.largest) < LARGEST_FILES:
+            heapq.heappush(plan.largest, item)
+        else:
+            heapq.heappushpop(plan.largest, item)
+
+        key = media_key(message)
+        if key and (key in seen or self.db.is_media_cached(dest_chat_id, key)):
+            plan.duplicates += 1
+            plan.duplicate_bytes += size
+            return
+        if key:
+            seen.add(key)
+        if message.noforwards or getattr(message.chat, "noforwards", False):
+            plan.protected += 1
+        elif isinstance(message.media, (MessageMediaPhoto, MessageMediaDocument)):
+            plan.reference_bytes += size
+
+    async def estimate(self, messages, size):
+        """Оценка времени в секундах по истории скорости или None"""
+        seconds, done_messages, done_bytes = await self.db.get_throughput()
+        if not seconds or not done_messages:
+            return None
+        eta = messages * seconds / done_messages
+        if done_bytes:
+            eta = max(eta, size * seconds / done_bytes)
+        return eta
+
+    def _log_plan(self, plan: SourcePlan):
+        logger.info(
+            f"План бэклога {plan.source_chat_id}: {plan.messages} сообщений, "
+            f"{plan.singles} одиночных, {plan.albums} медиагрупп, "
+            f"{format_size(plan.total_bytes)}"
+        )
+        for kind, count in sorted(plan.count_by_type.items()):
+            logger.info(
+                f"  {MEDIA_TYPE_LABELS[kind]}: {count}, "
+                f"{format_size(plan.bytes_by_type[kind])}"
+            )
+        for size, message_id, file_name in sorted(plan.largest, reverse=True):
+            logger.info(f"  {format_size(size)}: {file_name} (id: {message_id})")
+        logger.info(
+            f"  Повторы медиа: {plan.duplicates} файлов, кэш сэкономит "
+            f"{format_size(plan.duplicate_bytes)}"
+        )
+        logger.info(
+            f"  По ссылке (copy_mode reference) можно не передавать "
+            f"{format_size(plan.reference_bytes)}, защищенных от пересылки "
+            f"сообщений: {plan.protected}"
+        )
+
+    async def report(self):
+        """Запись плана в лог. Возвращает планы источников"""
+        plans = list(self.plans.values())
+        for plan in plans:
+            self._log_plan(plan)
+        messages = sum(plan.messages for plan in plans)
+        size = sum(plan.total_bytes for plan in plans)
+        eta = await self.estimate(messages, size)
+        if eta is None:
+            estimate = "оценки времени нет, скорость еще ни разу не замерялась"
+        else:
+            estimate = f"примерно {format_duration(eta)}"
+        logger.info(
+            f"Итого к перезаливке: {messages} сообщений, {format_size(size)}, {estimate}"
+        )
+        return plans
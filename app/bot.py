@@ -1,39 +1,117 @@
+import asyncio
 from pathlib import Path
 
 from loguru import logger
 from telethon import TelegramClient
 
-from .config import load_config, setup_logger
+from .config import Config, load_config, setup_logger
 from .database import Database
+from .metrics import metrics
+from .rate_limiter import RateScheduler
 from .sync_manager import SyncManager
 
 setup_logger()
 
 
 class CopycatBot:
-    def __init__(self):
-        self.config = load_config()
-        self.client = TelegramClient(
-            "sessions/CopycatBot",
+    def __init__(
+        self,
+        config: Config | None = None,
+        client: TelegramClient | None = None,
+        db: Database | None = None,
+        workers: dict[str, TelegramClient] | None = None,
+    ):
+        # Параметры можно подменить, например, в бенчмарке с фейковым клиентом
+        self.config = config or load_config()
+        self.client = client or self._make_client("CopycatBot")
+        if workers is None:
+            workers = {
+                name: self._make_client(name) for name in self.config.sessions
+            }
+        self.workers = workers
+        self.db = db or Database(
+            media_cache_size=self.config.media_cache_size,
+            legacy_dest_chat_id=self.config.legacy_dest_chat_id,
+        )
+        self.temp_dir = Path("temp")
+        self.temp_dir.mkdir(exist_ok=True)
+        self.scheduler = RateScheduler(self.config.rate_limits)
+        self.metrics_server: asyncio.Server | None = None
+        self.metrics_task: asyncio.Task | None = None
+        self.sync_manager = SyncManager(
+            self.client,
+            self.config,
+            self.db,
+            self.temp_dir,
+            self.scheduler,
+            self.workers,
+        )
+
+    def _make_client(self, session_name):
+        return TelegramClient(
+            f"sessions/{session_name}",
             self.config.api_id,
             self.config.api_hash,
             system_lang_code="ru",
             system_version="copycat-bot-from-the-outer-space",
             device_model="beta-the-naked-one",
             app_version="0.1.0",
+            # FloodWait любой длины обрабатывает RateScheduler, а не Telethon
+            flood_sleep_threshold=0,
         )
-        self.db = Database()
-        self.temp_dir = Path("temp")
-        self.temp_dir.mkdir(exist_ok=True)
-        self.sync_manager = SyncManager(
-            self.client, self.config, self.db, self.temp_dir
-        )
+
+    async def _start_metrics(self):
+        if not (self.config.metrics_port or self.config.metrics_log_interval):
+            return
+        metrics.configure(enabled=True)
+        if self.config.metrics_port:
+            self.metrics_server = await metrics.serve(self.config.metrics_port)
+        if self.config.metrics_log_interval:
+            self.metrics_task = asyncio.create_task(
+                metrics.log_periodically(self.config.metrics_log_interval)
+            )
+
+    async def _stop_metrics(self):
+        if self.metrics_task is not None:
+            self.metrics_task.cancel()
+            try:
+                await self.metrics_task
+            except asyncio.CancelledError:
+                pass
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
 
     async def run(self):
         await self.client.start()
+        if self.config.dry_run:
+            logger.info("Пробный прогон: план бэклога без скачивания")
+            try:
+                await self.sync_manager.sync_existing_files(dry_run=True)
+            finally:
+                await self.db.close()
+            return
+        for name, worker in self.workers.items():
+            # При первом запуске каждая сессия спросит свой номер и код
+            logger.info(f"Вход в сессию {name}")
+            await worker.start()
         logger.info("Бот запущен")
 
-        await self.sync_manager.sync_existing_files()
-        await self.sync_manager.monitor_new_files()
+        try:
+            await self._start_metrics()
+
+            # До подписки на новые сообщения, пока ничего не качается
+            file_handler = self.sync_manager.media_processor.file_handler
+            await file_handler.resumable_downloader.remove_stale()
+
+            # Подписка до скана бэклога: новые сообщения не теряются и
+            # перезаливаются сразу, не дожидаясь конца бэклога
+            await self.sync_manager.monitor_new_files()
+            await self.sync_manager.sync_existing_files()
 
-        await self.client.run_until_disconnected()
+            await self.client.run_until_disconnected()
+        finally:
+            await self.sync_manager.sync_engine.stop()
+            self.sync_manager.media_processor.transformer.shutdown()
+            await self._stop_metrics()
+            await self.db.close()
@@ -3,6 +3,8 @@ from sys import stdout
 
 from loguru import logger
 
+COPY_MODES = ("download", "reference", "stream")
+
 
 class Config:
     def __init__(self, config_path="config.json"):
@@ -10,8 +12,86 @@ class Config:
             config = json.load(f)
         self.api_id: int = config["api_id"]
         self.api_hash: str = config["api_hash"]
-        self.source_chat_id: int = config["source_chat_id"]
-        self.dest_chat_id: int = config["dest_chat_id"]
+        # Маршруты: источник -> группы назначения, в которые он копируется.
+        # Старый формат с одной парой source_chat_id и dest_chat_id
+        # превращается в один маршрут
+        routes = config.get("routes") or [
+            {"source": config["source_chat_id"], "dest": config["dest_chat_id"]}
+        ]
+        self.routes: dict[int, list[int]] = {}
+        for route in routes:
+            dests = route["dest"]
+            if not isinstance(dests, list):
+                dests = [dests]
+            route_dests = self.routes.setdefault(route["source"], [])
+            route_dests.extend(d for d in dests if d not in route_dests)
+        # Группа назначения из старого формата, нужна для переноса базы,
+        # в которой sync_state еще не знал о группах назначения
+        self.legacy_dest_chat_id: int | None = config.get("dest_chat_id")
+        # Способ копирования медиа: "download" — скачать и залить заново,
+        # "reference" — переотправить по серверной ссылке без скачивания,
+        # "stream" — скачивать и заливать одновременно, не трогая диск
+        self.copy_mode: str = config.get("copy_mode", "download")
+        if self.copy_mode not in COPY_MODES:
+            raise ValueError(
+                f"Неизвестный copy_mode: {self.copy_mode}, допустимо: {COPY_MODES}"
+            )
+        # Сколько кусков по 512 КБ может лежать в памяти при потоковой перезаливке
+        self.stream_buffer_chunks: int = config.get("stream_buffer_chunks", 8)
+        # Сколько сообщений или медиагрупп бэклога перезаливается одновременно
+        self.concurrency: int = config.get("concurrency", 4)
+        # Сколько файлов одной медиагруппы скачивается одновременно
+        self.album_concurrency: int = config.get("album_concurrency", 4)
+        # Лимиты запросов в секунду по типам операций, дополняют значения
+        # по умолчанию из rate_limiter.DEFAULT_RATE_LIMITS
+        self.rate_limits: dict[str, float] = config.get("rate_limits", {})
+        # Документы от этого размера (в байтах) качаются с докачкой
+        self.resumable_min_size: int = config.get(
+            "resumable_min_size", 20 * 1024 * 1024
+        )
+        # Документы от этого размера качаются по диапазонам через
+        # parallel_parts соединений одновременно
+        self.parallel_min_size: int = config.get(
+            "parallel_min_size", 100 * 1024 * 1024
+        )
+        self.parallel_parts: int = config.get("parallel_parts", 4)
+        # Сколько байт могут одновременно занимать скачанные файлы; пока
+        # места нет, новые скачивания ждут. Файлы не больше spool_max_size
+        # скачиваются в память, а не на диск
+        self.temp_budget: int = config.get(
+            "temp_budget", 2 * 1024 * 1024 * 1024
+        )
+        self.spool_max_size: int = config.get("spool_max_size", 1024 * 1024)
+        # Бэклог через takeout-сессию Telegram с мягкими лимитами для
+        # выгрузки истории и максимальный размер файла, который она отдает
+        self.takeout: bool = config.get("takeout", False)
+        self.takeout_max_file_size: int = config.get(
+            "takeout_max_file_size", 4000 * 1024 * 1024
+        )
+        # На сколько диапазонов ID делить бэклог для параллельного скана
+        self.scan_ranges: int = config.get("scan_ranges", 1)
+        # Преобразования медиа между скачиванием и заливкой: имя -> настройки
+        # с фильтром mime_types, min_size, max_size. Выполняются по порядку
+        # в transform_workers процессах
+        self.transforms: dict[str, dict] = config.get("transforms", {})
+        self.transform_workers: int = config.get("transform_workers", 2)
+        # Имена дополнительных сессий (файлы в sessions/), между которыми
+        # делится скачивание и заливка
+        self.sessions: list[str] = config.get("sessions", [])
+        # Пробный прогон: только план бэклога с оценкой времени и индекс
+        # скана, без скачивания и отправки
+        self.dry_run: bool = config.get("dry_run", False)
+        # Сколько раз пытаться перезалить сообщение, прежде чем перенести
+        # его в dead_letter, и базовая пауза между попытками в секундах
+        self.max_attempts: int = config.get("max_attempts", 5)
+        self.retry_delay: int = config.get("retry_delay", 30)
+        # Сколько отправленных медиа помнить, чтобы репосты отправлять по
+        # ссылке без перезаливки
+        self.media_cache_size: int = config.get("media_cache_size", 10000)
+        # Порт локального эндпоинта метрик Prometheus и интервал сводки
+        # метрик в лог в секундах; если оба не заданы, метрики выключены
+        self.metrics_port: int | None = config.get("metrics_port")
+        self.metrics_log_interval: int = config.get("metrics_log_interval", 0)
 
 
 def load_config():
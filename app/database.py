@@ -1,30 +1,336 @@
+import asyncio
+import itertools
 import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .metrics import metrics
+
+SAVE_SYNC_STATE_SQL = "INSERT OR REPLACE INTO sync_state (source_chat_id, message_id, dest_chat_id, dest_message_id, file_name) VALUES (?, ?, ?, ?, ?)"
+UPDATE_LAST_PROCESSED_SQL = """
+    INSERT INTO last_processed (chat_id, last_message_id) VALUES (?, ?)
+    ON CONFLICT(chat_id) DO UPDATE SET
+        last_message_id = MAX(last_message_id, excluded.last_message_id)
+"""
+JOURNAL_ENQUEUE_SQL = """
+    INSERT INTO journal (source_chat_id, message_id, grouped_id, live, state)
+    VALUES (?, ?, ?, ?, 'queued')
+    ON CONFLICT(source_chat_id, message_id) DO UPDATE SET
+        state = 'queued', updated_at = CURRENT_TIMESTAMP
+"""
+JOURNAL_STATE_SQL = """
+    UPDATE journal SET state = ?, dest_chat_id = ?, dest_max_id = ?,
+        send_seq = ?, send_caption = ?, send_session = ?,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE source_chat_id = ? AND message_id = ?
+"""
+JOURNAL_DELETE_SQL = (
+    "DELETE FROM journal WHERE source_chat_id = ? AND message_id = ?"
+)
+MEDIA_CACHE_SAVE_SQL = """
+    INSERT OR REPLACE INTO media_cache
+        (dest_chat_id, media_key, content_hash, dest_message_id, input_media, used_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+MEDIA_CACHE_TOUCH_SQL = "UPDATE media_cache SET used_at = ? WHERE dest_chat_id = ? AND media_key = ?"
+MEDIA_CACHE_DELETE_SQL = (
+    "DELETE FROM media_cache WHERE dest_chat_id = ? AND media_key = ?"
+)
+SAVE_PEER_SQL = "INSERT OR REPLACE INTO peers (peer_id, peer_type, access_hash) VALUES (?, ?, ?)"
+SAVE_THROUGHPUT_SQL = (
+    "INSERT INTO throughput (seconds, messages, bytes) VALUES (?, ?, ?)"
+)
+
+# Состояния единицы работы в журнале. После отправки запись удаляется
+# из журнала в одной транзакции с записью в sync_state
+JOURNAL_STATES = ("queued", "downloading", "uploaded", "sending")
+
+
+class SyncedIndex:
+    """Битовая карта ID сообщений одного источника, синхронизированных в
+    одну группу назначения.
+
+    ID сообщений в канале идут почти подряд, поэтому на миллион
+    сообщений уходит около 125 КБ памяти.
+    """
+
+    def __init__(self):
+        self._bits = bytearray()
+
+    def add(self, message_id):
+        byte = message_id >> 3
+        if byte >= len(self._bits):
+            self._bits.extend(
+                bytes(max(byte + 1, len(self._bits) * 2) - len(self._bits))
+            )
+        self._bits[byte] |= 1 << (message_id & 7)
+
+    def __contains__(self, message_id):
+        byte = message_id >> 3
+        return (
+            byte < len(self._bits) and (self._bits[byte] >> (message_id & 7)) & 1
+        )
 
 
 class Database:
-    def __init__(self, db_path="state.db"):
-        self.db = sqlite3.connect(db_path)
-        self._init_db()
+    """Состояние синхронизации в SQLite.
 
-    def _init_db(self):
+    Сообщение считается синхронизированным отдельно для каждой группы
+    назначения своего источника, все ключи включают ID чатов. Проверка
+    is_message_synced идет по индексу в памяти, загруженному при старте.
+    Записи копятся и сохраняются пачками в одной транзакции, а все
+    обращения к SQLite выполняются в отдельном потоке, чтобы не блокировать
+    сетевой ввод-вывод Telethon.
+
+    Журнал хранит состояние каждой незавершенной единицы работы, чтобы
+    после перезапуска продолжить с того же места, а сообщения, которые не
+    удалось перезалить за max_attempts попыток, попадают в dead_letter.
+
+    Кэш медиа помнит, в каком сообщении группы назначения уже лежит файл,
+    и ссылку на него, чтобы репост того же файла отправить по ссылке, а
+    не перезаливать.
+    Кэш целиком держится в памяти и ограничен media_cache_size записями,
+    лишние вытесняются по давности использования (LRU).
+
+    История скорости бэклога (throughput) нужна для оценки времени в
+    пробном прогоне, а индекс скана (scan_index) хранит найденные им
+    сообщения с медиа, чтобы настоящий прогон не сканировал историю.
+    """
+
+    def __init__(
+        self,
+        db_path="state.db",
+        batch_size=50,
+        flush_interval=0.5,
+        media_cache_size=10000,
+        legacy_dest_chat_id=None,
+    ):
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Один поток, чтобы обращения к соединению шли строго по очереди
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="sqlite"
+        )
+        self._synced: dict[tuple[int, int], SyncedIndex] = {}
+        # Отложенные запросы, выполняются по порядку в одной транзакции
+        self._pending: list[tuple[str, tuple]] = []
+        self._pending_dest: dict[tuple[int, int, int], int] = {}
+        self._pending_last: dict[int, int] = {}
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._send_seq = itertools.count()
+        # Отправки в одну группу назначения идут по одной, см. dest_lock
+        self._dest_locks: dict[int, asyncio.Lock] = {}
+        self.media_cache_size = media_cache_size
+        # (dest_chat_id, media_key) -> (dest_message_id, content_hash,
+        # input_media), от давно использованных к недавним
+        self._media_cache: OrderedDict[tuple[int, str], tuple] = OrderedDict()
+        # (dest_chat_id, content_hash) -> media_key
+        self._media_by_hash: dict[tuple[int, str], str] = {}
+        self._media_clock = 0
+        # peer_id -> (peer_type, access_hash) разрешенных чатов
+        self._peers: dict[int, tuple[str, int]] = {}
+        self._init_db(legacy_dest_chat_id)
+        self._load_synced()
+        self._load_media_cache()
+        self._load_peers()
+
+    def _columns(self, table):
+        cursor = self.db.execute(f"PRAGMA table_info({table})")
+        return {row[1] for row in cursor}
+
+    def _migrate(self, legacy_dest_chat_id):
+        """Перенос базы, в которой были один источник и одна группа назначения.
+
+        В старой sync_state первичным ключом был только message_id, а
+        группа назначения не хранилась вовсе, ее берем из конфига.
+        """
+        columns = self._columns("sync_state")
+        if columns and "dest_chat_id" not in columns:
+            if legacy_dest_chat_id is None:
+                raise RuntimeError(
+                    "Для переноса старой базы укажите dest_chat_id в config.json"
+                )
+            self.db.execute("ALTER TABLE sync_state RENAME TO sync_state_old")
+            self._create_sync_state()
+            self.db.execute(
+                """
+                INSERT INTO sync_state (source_chat_id, message_id, dest_chat_id,
+                    dest_message_id, file_name, synced_at)
+                SELECT source_chat_id, message_id, ?, dest_message_id,
+                    file_name, synced_at
+                FROM sync_state_old
+                """,
+                (legacy_dest_chat_id,),
+            )
+            self.db.execute("DROP TABLE sync_state_old")
+        columns = self._columns("journal")
+        if columns and "dest_chat_id" not in columns:
+            self.db.execute("ALTER TABLE journal ADD COLUMN dest_chat_id INTEGER")
+            self.db.execute(
+                "UPDATE journal SET dest_chat_id = ? WHERE state = 'sending'",
+                (legacy_dest_chat_id,),
+            )
+        if columns and "send_caption" not in columns:
+            self.db.execute("ALTER TABLE journal ADD COLUMN send_caption TEXT")
+        if columns and "send_session" not in columns:
+            self.db.execute("ALTER TABLE journal ADD COLUMN send_session TEXT")
+
+    def _create_sync_state(self):
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS sync_state (
+                source_chat_id INTEGER,
+                message_id INTEGER,
+                dest_chat_id INTEGER,
+                dest_message_id INTEGER,
+                file_name TEXT,
+                synced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (source_chat_id, message_id, dest_chat_id)
+            )
+        """)
+
+    def _init_db(self, legacy_dest_chat_id=None):
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
         with self.db:
+            self._migrate(legacy_dest_chat_id)
+            self._create_sync_state()
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS last_processed (
+                    chat_id INTEGER PRIMARY KEY,
+                    last_message_id INTEGER
+                )
+            """)
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS download_progress (
+                    file_key TEXT PRIMARY KEY,
+                    path TEXT,
+                    total_size INTEGER,
+                    downloaded INTEGER,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS journal (
+                    source_chat_id INTEGER,
+                    message_id INTEGER,
+                    grouped_id INTEGER,
+                    live INTEGER,
+                    state TEXT,
+                    attempts INTEGER DEFAULT 0,
+                    last_error TEXT,
+                    dest_chat_id INTEGER,
+                    dest_max_id INTEGER,
+                    send_seq INTEGER,
+                    send_caption TEXT,
+                    send_session TEXT,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (source_chat_id, message_id)
+                )
+            """)
             self.db.execute("""
-                CREATE TABLE IF NOT EXISTS sync_state (
-                    message_id INTEGER PRIMARY KEY,
+                CREATE TABLE IF NOT EXISTS dead_letter (
                     source_chat_id INTEGER,
+                    message_id INTEGER,
+                    grouped_id INTEGER,
+                    attempts INTEGER,
+                    last_error TEXT,
+                    failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (source_chat_id, message_id)
+                )
+            """)
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS media_cache (
+                    dest_chat_id INTEGER,
+                    media_key TEXT,
+                    content_hash TEXT,
                     dest_message_id INTEGER,
-                    file_name TEXT,
-                    synced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    input_media BLOB,
+                    used_at INTEGER,
+                    PRIMARY KEY (dest_chat_id, media_key)
                 )
             """)
             self.db.execute("""
-                CREATE TABLE IF NOT EXISTS last_processed (
-                    chat_id INTEGER PRIMARY KEY,
-                    last_message_id INTEGER
+                CREATE TABLE IF NOT EXISTS peers (
+                    peer_id INTEGER PRIMARY KEY,
+                    peer_type TEXT,
+                    access_hash INTEGER
+                )
+            """)
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS throughput (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    seconds REAL,
+                    messages INTEGER,
+                    bytes INTEGER,
+                    recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS scan_index (
+                    source_chat_id INTEGER,
+                    message_id INTEGER,
+                    PRIMARY KEY (source_chat_id, message_id)
                 )
             """)
 
-    def get_last_processed_id(self, chat_id):
+    def _load_synced(self):
+        cursor = self.db.execute(
+            "SELECT source_chat_id, dest_chat_id, message_id FROM sync_state"
+        )
+        for source_chat_id, dest_chat_id, message_id in cursor:
+            self._index(source_chat_id, dest_chat_id).add(message_id)
+        cursor = self.db.execute(
+            "SELECT dest_chat_id, MAX(dest_message_id) FROM sync_state GROUP BY dest_chat_id"
+        )
+        # Последний известный ID в каждой группе назначения, нужен для
+        # сверки отправок, прерванных падением бота
+        self.last_dest_message_ids: dict[int, int] = dict(cursor.fetchall())
+
+    def _load_media_cache(self):
+        cursor = self.db.execute(
+            """
+            SELECT dest_chat_id, media_key, content_hash, dest_message_id,
+                input_media, used_at
+            FROM media_cache ORDER BY used_at
+            """
+        )
+        for (
+            dest_chat_id,
+            media_key,
+            content_hash,
+            dest_message_id,
+            input_media,
+            used_at,
+        ) in cursor:
+            self._media_cache[(dest_chat_id, media_key)] = (
+                dest_message_id,
+                content_hash,
+                input_media,
+            )
+            if content_hash:
+                self._media_by_hash[(dest_chat_id, content_hash)] = media_key
+            self._media_clock = max(self._media_clock, used_at)
+
+    def _load_peers(self):
+        cursor = self.db.execute(
+            "SELECT peer_id, peer_type, access_hash FROM peers"
+        )
+        for peer_id, peer_type, access_hash in cursor:
+            self._peers[peer_id] = (peer_type, access_hash)
+
+    def _index(self, source_chat_id, dest_chat_id):
+        key = (source_chat_id, dest_chat_id)
+        index = self._synced.get(key)
+        if index is None:
+            index = self._synced[key] = SyncedIndex()
+        return index
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _get_last_processed_id(self, chat_id):
         cursor = self.db.execute(
             "SELECT last_message_id FROM last_processed WHERE chat_id = ?",
             (chat_id,),
@@ -32,36 +338,459 @@ class Database:
         result = cursor.fetchone()
         return result[0] if result else 0
 
-    def update_last_processed_id(self, chat_id, message_id):
+    async def get_last_processed_id(self, chat_id):
+        last_id = await self._run(self._get_last_processed_id, chat_id)
+        return max(last_id, self._pending_last.get(chat_id, 0))
+
+    def is_message_synced(self, message_id, source_chat_id, dest_chat_id):
+        return message_id in self._index(source_chat_id, dest_chat_id)
+
+    async def _queue(self, statements):
+        """Постановка запросов в очередь на запись пачкой"""
+        self._pending.extend(statements)
+        if len(self._pending) >= self.batch_size:
+            await self.flush()
+        elif self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(
+                self.flush_interval, lambda: asyncio.create_task(self.flush())
+            )
+
+    async def journal_enqueue(
+        self, source_chat_id, messages, live=False, watermark=None
+    ):
+        """Запись единицы работы в журнал в состоянии queued.
+
+        messages — список (message_id, grouped_id). watermark сдвигает
+        last_processed в той же транзакции: все, что до него, уже либо
+        синхронизировано, либо лежит в журнале.
+        """
+        statements = [
+            (
+                JOURNAL_ENQUEUE_SQL,
+                (source_chat_id, message_id, grouped_id, int(live)),
+            )
+            for message_id, grouped_id in messages
+        ]
+        if watermark is not None:
+            statements.append(
+                (UPDATE_LAST_PROCESSED_SQL, (source_chat_id, watermark))
+            )
+            self._pending_last[source_chat_id] = max(
+                self._pending_last.get(source_chat_id, 0), watermark
+            )
+        await self._queue(statements)
+
+    def dest_lock(self, dest_chat_id):
+        """Блокировка отправок в группу назначения.
+
+        Под ней записывается состояние sending и выполняется сам запрос
+        отправки, поэтому посты отправок в группу идут в порядке send_seq
+        и не перемешиваются между полосами, источниками и сессиями.
+        """
+        lock = self._dest_locks.get(dest_chat_id)
+        if lock is None:
+            lock = self._dest_locks[dest_chat_id] = asyncio.Lock()
+        return lock
+
+    def note_dest_message_id(self, dest_chat_id, dest_message_id):
+        """Учет ID сообщения в группе назначения для dest_max_id"""
+        self.last_dest_message_ids[dest_chat_id] = max(
+            self.last_dest_message_ids.get(dest_chat_id, 0), dest_message_id
+        )
+
+    async def journal_set_state(
+        self,
+        source_chat_id,
+        message_ids,
+        state,
+        dest_chat_id=None,
+        caption=None,
+        session=None,
+    ):
+        """Смена состояния единицы работы в журнале.
+
+        Состояние sending записывается под dest_lock прямо перед запросом
+        отправки в dest_chat_id, вместе с последним известным ID в этой
+        группе назначения, подписью и именем сессии пула, от которой уйдет
+        пост: по ним после падения можно найти пост отправки и понять,
+        успела ли она дойти.
+        """
+        dest_max_id = send_seq = None
+        if state == "sending":
+            dest_max_id = self.last_dest_message_ids.get(dest_chat_id, 0)
+            send_seq = next(self._send_seq)
+        await self._queue(
+            [
+                (
+                    JOURNAL_STATE_SQL,
+                    (
+                        state,
+                        dest_chat_id,
+                        dest_max_id,
+                        send_seq,
+                        caption,
+                        session,
+                        source_chat_id,
+                        message_id,
+                    ),
+                )
+                for message_id in message_ids
+            ]
+        )
+        if state == "sending":
+            await self.flush()
+
+    def _get_journal(self, source_chat_id):
+        cursor = self.db.execute(
+            """
+            SELECT message_id, grouped_id, live, state, dest_max_id, send_seq,
+                dest_chat_id, send_caption, send_session
+            FROM journal WHERE source_chat_id = ? ORDER BY message_id
+            """,
+            (source_chat_id,),
+        )
+        return cursor.fetchall()
+
+    async def get_journal(self, source_chat_id):
+        """Незавершенные записи журнала: (message_id, grouped_id, live,
+        state, dest_max_id, send_seq, dest_chat_id, send_caption,
+        send_session) по возрастанию message_id"""
+        await self.flush()
+        return await self._run(self._get_journal, source_chat_id)
+
+    def _get_synced_dest_ids(self, dest_chat_id, min_id):
+        cursor = self.db.execute(
+            """
+            SELECT dest_message_id FROM sync_state
+            WHERE dest_chat_id = ? AND dest_message_id > ?
+            """,
+            (dest_chat_id, min_id),
+        )
+        return {row[0] for row in cursor}
+
+    async def get_synced_dest_ids(self, dest_chat_id, min_id):
+        """ID сообщений группы назначения больше min_id, уже записанных в
+        sync_state"""
+        await self.flush()
+        return await self._run(self._get_synced_dest_ids, dest_chat_id, min_id)
+
+    def _journal_fail(self, source_chat_id, message_ids, error, max_attempts):
+        dead = []
+        attempts = 0
+        with self.db:
+            for message_id in message_ids:
+                self.db.execute(
+                    """
+                    UPDATE journal SET state = 'queued', attempts = attempts + 1,
+                        last_error = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE source_chat_id = ? AND message_id = ?
+                    """,
+                    (error, source_chat_id, message_id),
+                )
+                row = self.db.execute(
+                    "SELECT grouped_id, attempts FROM journal WHERE source_chat_id = ? AND message_id = ?",
+                    (source_chat_id, message_id),
+                ).fetchone()
+                if row and row[1] >= max_attempts:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO dead_letter (source_chat_id, message_id, grouped_id, attempts, last_error) VALUES (?, ?, ?, ?, ?)",
+                        (source_chat_id, message_id, row[0], row[1], error),
+                    )
+                    self.db.execute(
+                        JOURNAL_DELETE_SQL, (source_chat_id, message_id)
+                    )
+                    dead.append(message_id)
+                elif row:
+                    attempts = max(attempts, row[1])
+        return dead, attempts
+
+    async def journal_fail(
+        self, source_chat_id, message_ids, error, max_attempts
+    ):
+        """Учет неудачной попытки. Возвращает ID сообщений, которые
+        исчерпали попытки и перенесены в dead_letter, и число сделанных
+        попыток у остальных"""
+        await self.flush()
+        return await self._run(
+            self._journal_fail, source_chat_id, message_ids, error, max_attempts
+        )
+
+    async def save_synced(
+        self, source_chat_id, dest_chat_id, records, finished=True
+    ):
+        """Сохранение отправки единицы работы в одну группу назначения.
+
+        records — список (message_id, dest_message_id, file_name). Записи
+        сразу попадают в индекс в памяти, а в базу уходят пачкой. Если
+        группа назначения последняя (finished), в той же пачке единица
+        работы удаляется из журнала.
+        """
+        index = self._index(source_chat_id, dest_chat_id)
+        statements = []
+        for message_id, dest_message_id, file_name in records:
+            index.add(message_id)
+            statements.append(
+                (
+                    SAVE_SYNC_STATE_SQL,
+                    (
+                        source_chat_id,
+                        message_id,
+                        dest_chat_id,
+                        dest_message_id,
+                        file_name,
+                    ),
+                )
+            )
+            if finished:
+                statements.append(
+                    (JOURNAL_DELETE_SQL, (source_chat_id, message_id))
+                )
+            self._pending_dest[(source_chat_id, message_id, dest_chat_id)] = (
+                dest_message_id
+            )
+            self.note_dest_message_id(dest_chat_id, dest_message_id)
+        await self._queue(statements)
+
+    async def journal_finish(self, source_chat_id, message_ids):
+        """Удаление из журнала единицы работы, уже отправленной везде"""
+        await self._queue(
+            [
+                (JOURNAL_DELETE_SQL, (source_chat_id, message_id))
+                for message_id in message_ids
+            ]
+        )
+
+    def get_peer(self, peer_id):
+        """Сохраненные (peer_type, access_hash) чата или None"""
+        return self._peers.get(peer_id)
+
+    async def save_peer(self, peer_id, peer_type, access_hash):
+        self._peers[peer_id] = (peer_type, access_hash)
+        await self._queue([(SAVE_PEER_SQL, (peer_id, peer_type, access_hash))])
+
+    def is_media_cached(self, dest_chat_id, media_key):
+        """Есть ли медиа в кэше группы назначения, без отметки об использовании"""
+        return (dest_chat_id, media_key) in self._media_cache
+
+    def _media_tick(self):
+        # Счетчик вместо времени: порядок использования не зависит от часов
+        self._media_clock += 1
+        return self._media_clock
+
+    async def get_cached_media(self, dest_chat_id, media_key, content_hash=None):
+        """Сериализованный InputMedia уже отправленной копии или None.
+
+        Сначала ищется по ключу медиа (ID фото или документа в Telegram),
+        затем по хэшу содержимого, если он известен.
+        """
+        key = (dest_chat_id, media_key)
+        if key not in self._media_cache and content_hash:
+            by_hash = self._media_by_hash.get((dest_chat_id, content_hash))
+            key = (dest_chat_id, by_hash)
+        entry = self._media_cache.get(key)
+        if entry is None:
+            return None
+        self._media_cache.move_to_end(key)
+        await self._queue(
+            [(MEDIA_CACHE_TOUCH_SQL, (self._media_tick(), *key))]
+        )
+        return entry[2]
+
+    async def cache_media(
+        self, dest_chat_id, media_key, content_hash, dest_message_id, input_media
+    ):
+        """Запоминание отправленного медиа с вытеснением самых старых записей"""
+        key = (dest_chat_id, media_key)
+        self._media_cache[key] = (dest_message_id, content_hash, input_media)
+        self._media_cache.move_to_end(key)
+        if content_hash:
+            self._media_by_hash[(dest_chat_id, content_hash)] = media_key
+        statements = [
+            (
+                MEDIA_CACHE_SAVE_SQL,
+                (
+                    dest_chat_id,
+                    media_key,
+                    content_hash,
+                    dest_message_id,
+                    input_media,
+                    self._media_tick(),
+                ),
+            )
+        ]
+        while len(self._media_cache) > self.media_cache_size:
+            old_key, (_, old_hash, _) = self._media_cache.popitem(last=False)
+            hash_key = (old_key[0], old_hash)
+            # Хэш мог уже перейти к другой записи с тем же содержимым
+            if old_hash and self._media_by_hash.get(hash_key) == old_key[1]:
+                del self._media_by_hash[hash_key]
+            statements.append((MEDIA_CACHE_DELETE_SQL, old_key))
+        await self._queue(statements)
+
+    async def save_throughput(self, seconds, messages, size):
+        """Замер скорости бэклога: сколько сообщений и байт ушло за seconds"""
+        await self._queue([(SAVE_THROUGHPUT_SQL, (seconds, messages, size))])
+
+    def _get_throughput(self, samples):
+        cursor = self.db.execute(
+            """
+            SELECT SUM(seconds), SUM(messages), SUM(bytes) FROM (
+                SELECT seconds, messages, bytes FROM throughput
+                ORDER BY id DESC LIMIT ?
+            )
+            """,
+            (samples,),
+        )
+        seconds, messages, size = cursor.fetchone()
+        return seconds or 0.0, messages or 0, size or 0
+
+    async def get_throughput(self, samples=100):
+        """Сумма (seconds, messages, bytes) последних samples замеров"""
+        await self.flush()
+        return await self._run(self._get_throughput, samples)
+
+    def _save_scan_index(self, source_chat_id, message_ids):
         with self.db:
             self.db.execute(
-                "INSERT OR REPLACE INTO last_processed (chat_id, last_message_id) VALUES (?, ?)",
-                (chat_id, message_id),
+                "DELETE FROM scan_index WHERE source_chat_id = ?",
+                (source_chat_id,),
+            )
+            self.db.executemany(
+                "INSERT INTO scan_index (source_chat_id, message_id) VALUES (?, ?)",
+                [(source_chat_id, message_id) for message_id in message_ids],
             )
 
-    def is_message_synced(self, message_id):
+    async def save_scan_index(self, source_chat_id, message_ids):
+        """Замена индекса скана источника новым списком ID сообщений"""
+        await self._run(self._save_scan_index, source_chat_id, message_ids)
+
+    def _get_scan_index(self, source_chat_id, after_id):
         cursor = self.db.execute(
-            "SELECT 1 FROM sync_state WHERE message_id = ?", (message_id,)
+            "SELECT message_id FROM scan_index WHERE source_chat_id = ? AND message_id > ? ORDER BY message_id",
+            (source_chat_id, after_id),
         )
-        return cursor.fetchone() is not None
+        return [row[0] for row in cursor]
 
-    def save_sync_state(
-        self, source_msg_id, source_chat_id, dest_msg_id, file_name
-    ):
+    async def get_scan_index(self, source_chat_id, after_id=0):
+        """ID сообщений из индекса скана после after_id по возрастанию"""
+        return await self._run(self._get_scan_index, source_chat_id, after_id)
+
+    def _clear_scan_index(self, source_chat_id):
         with self.db:
             self.db.execute(
-                "INSERT INTO sync_state (message_id, source_chat_id, dest_message_id, file_name) VALUES (?, ?, ?, ?)",
-                (source_msg_id, source_chat_id, dest_msg_id, file_name),
+                "DELETE FROM scan_index WHERE source_chat_id = ?",
+                (source_chat_id,),
             )
 
-    def get_dest_message_id(self, message_id, source_chat_id):
-        """Получить ID сообщения в группе назначения для заданного исходного сообщения."""
+    async def clear_scan_index(self, source_chat_id):
+        await self._run(self._clear_scan_index, source_chat_id)
+
+    def _write_batch(self, statements):
+        with self.db:
+            # Подряд идущие одинаковые запросы выполняются одним executemany
+            for sql, group in itertools.groupby(statements, key=lambda x: x[0]):
+                self.db.executemany(sql, [params for _, params in group])
+
+    async def flush(self):
+        """Запись накопленных изменений в базу одной транзакцией"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        statements, self._pending = self._pending, []
+        pending_dest, self._pending_dest = self._pending_dest, {}
+        pending_last, self._pending_last = self._pending_last, {}
+        try:
+            with metrics.timer("db_commit"):
+                await self._run(self._write_batch, statements)
+        except Exception:
+            # Возвращаем записи, чтобы сохранить их при следующей попытке
+            self._pending = statements + self._pending
+            self._pending_dest = pending_dest | self._pending_dest
+            for chat_id, last_id in pending_last.items():
+                self._pending_last[chat_id] = max(
+                    self._pending_last.get(chat_id, 0), last_id
+                )
+            raise
+
+    def _get_dest_message_id(self, message_id, source_chat_id, dest_chat_id):
         cursor = self.db.execute(
-            "SELECT dest_message_id FROM sync_state WHERE message_id = ? AND source_chat_id = ?",
-            (message_id, source_chat_id),
+            "SELECT dest_message_id FROM sync_state WHERE source_chat_id = ? AND message_id = ? AND dest_chat_id = ?",
+            (source_chat_id, message_id, dest_chat_id),
         )
         result = cursor.fetchone()
         return result[0] if result else None
 
-    def __del__(self):
-        self.db.close()
+    async def get_dest_message_id(self, message_id, source_chat_id, dest_chat_id):
+        """Получить ID сообщения в группе назначения для заданного исходного сообщения."""
+        dest_message_id = self._pending_dest.get(
+            (source_chat_id, message_id, dest_chat_id)
+        )
+        if dest_message_id is not None:
+            return dest_message_id
+        return await self._run(
+            self._get_dest_message_id, message_id, source_chat_id, dest_chat_id
+        )
+
+    def _get_download_progress(self, file_key):
+        cursor = self.db.execute(
+            "SELECT path, total_size, downloaded FROM download_progress WHERE file_key = ?",
+            (file_key,),
+        )
+        return cursor.fetchone()
+
+    async def get_download_progress(self, file_key):
+        """Прогресс незавершенного скачивания: (path, total_size, downloaded) или None"""
+        return await self._run(self._get_download_progress, file_key)
+
+    def _save_download_progress(self, file_key, path, total_size, downloaded):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO download_progress (file_key, path, total_size, downloaded) VALUES (?, ?, ?, ?)",
+                (file_key, path, total_size, downloaded),
+            )
+
+    async def save_download_progress(self, file_key, path, total_size, downloaded):
+        await self._run(
+            self._save_download_progress, file_key, path, total_size, downloaded
+        )
+
+    def _clear_download_progress(self, file_key):
+        with self.db:
+            self.db.execute(
+                "DELETE FROM download_progress WHERE file_key = ? OR file_key LIKE ?",
+                (file_key, f"{file_key}:%"),
+            )
+
+    async def clear_download_progress(self, file_key):
+        """Удаление прогресса файла вместе с прогрессом его диапазонов"""
+        await self._run(self._clear_download_progress, file_key)
+
+    def _expire_download_progress(self, max_age):
+        with self.db:
+            # Диапазоны одного файла устаревают вместе, по самому свежему
+            self.db.execute(
+                """
+                DELETE FROM download_progress WHERE path IN (
+                    SELECT path FROM download_progress GROUP BY path
+                    HAVING MAX(updated_at) < datetime('now', ?)
+                )
+                """,
+                (f"-{max_age} seconds",),
+            )
+        cursor = self.db.execute("SELECT DISTINCT path FROM download_progress")
+        return {path for (path,) in cursor.fetchall()}
+
+    async def expire_download_progress(self, max_age):
+        """Удаление прогресса скачиваний, не обновлявшегося max_age секунд.
+
+        Возвращает пути файлов, прогресс которых остался.
+        """
+        return await self._run(self._expire_download_progress, max_age)
+
+    async def close(self):
+        await self.flush()
+        await self._run(self.db.close)
+        self._executor.shutdown()
@@ -1,73 +1,243 @@
 import asyncio
+import hashlib
+from contextlib import nullcontext
 from pathlib import Path
 
 from loguru import logger
 from telethon import TelegramClient
-from telethon.errors import RPCError
+from telethon.errors import (
+    ChatForwardsRestrictedError,
+    FileReferenceExpiredError,
+    RPCError,
+)
 from telethon.tl.custom.message import Message
 
+from .config import Config
+from .database import Database
+from .metrics import metrics
+from .parallel_download import ParallelDownloader
+from .rate_limiter import RateScheduler
+from .resumable_download import ResumableDownloader
+from .stream_transfer import StreamTransfer, uploaded_media
+from .temp_storage import TempSlot, TempStorage
+
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _file_hash(file_path: Path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_size(file: Path | bytes):
+    """Размер скачанного файла на диске или в памяти"""
+    return len(file) if isinstance(file, bytes) else file.stat().st_size
+
 
 class FileHandler:
-    def __init__(self, client: TelegramClient, temp_dir: Path):
+    """Скачивание и заливка файлов.
+
+    Все запросы к Telegram идут через RateScheduler, который соблюдает
+    лимиты, FloodWait и повторяет временные ошибки. Сессии пула делят
+    один TempStorage, чтобы бюджет временных файлов был общим.
+    """
+
+    def __init__(
+        self,
+        client: TelegramClient,
+        config: Config,
+        db: Database,
+        temp_dir: Path,
+        scheduler: RateScheduler,
+        temp_storage: TempStorage | None = None,
+    ):
         self.client = client
+        self.config = config
         self.temp_dir = temp_dir
+        self.scheduler = scheduler
+        self.stream_transfer = StreamTransfer(
+            client, scheduler, config.stream_buffer_chunks
+        )
+        self.resumable_downloader = ResumableDownloader(
+            client, scheduler, db, temp_dir
+        )
+        self.parallel_downloader = ParallelDownloader(
+            client, scheduler, db, temp_dir, config.parallel_parts
+        )
+        if temp_storage is None:
+            temp_storage = TempStorage(
+                temp_dir, config.temp_budget, config.spool_max_size
+            )
+            temp_storage.remove_leftovers()
+        self.temp_storage = temp_storage
 
     async def download_media_with_retry(
-        self, message: Message, file_name, retries=3, delay=2
+        self, message: Message, file_name, slot: TempSlot
     ):
-        """Скачивание медиа с повторными попытками"""
-        for attempt in range(retries):
+        """Скачивание медиа с повторными попытками.
+
+        Большие документы качаются кусками с докачкой после обрыва или
+        перезапуска, самые большие — еще и в несколько соединений,
+        остальное медиа — обычным download_media в путь слота или, если
+        у слота нет пути, в память. Возвращает Path или bytes.
+        """
+        size = message.file.size if StreamTransfer.supports(message) else 0
+        if size and size >= self.config.resumable_min_size:
+            if size >= self.config.parallel_min_size:
+                downloader = self.parallel_downloader
+            else:
+                downloader = self.resumable_downloader
             try:
-                file_path = await message.download_media(
-                    file=self.temp_dir / file_name
+                with metrics.timer("download"):
+                    file_path = await downloader.download(
+                        message, slot.path or self.temp_storage.unique_path(file_name)
+                    )
+            except (RPCError, OSError, RuntimeError) as e:
+                logger.warning(f"Ошибка скачивания {file_name}: {str(e)}")
+                return None
+            metrics.inc("downloaded_bytes", size)
+            return file_path
+
+        try:
+            with metrics.timer("download"):
+                file_path = await self.scheduler.call(
+                    "download",
+                    message.download_media,
+                    file=slot.path or bytes,
                 )
-                if file_path and Path(file_path).exists():
-                    return Path(file_path)
-                logger.warning(
-                    f"Попытка {attempt + 1}: Не удалось скачать {file_name}"
+        except (RPCError, OSError) as e:
+            logger.warning(f"Ошибка скачивания {file_name}: {str(e)}")
+            return None
+        if isinstance(file_path, bytes):
+            metrics.inc("downloaded_bytes", len(file_path))
+            return file_path
+        if file_path and Path(file_path).exists():
+            file_path = Path(file_path)
+            metrics.inc("downloaded_bytes", file_path.stat().st_size)
+            return file_path
+        logger.warning(f"Не удалось скачать {file_name}")
+        return None
+
+    async def upload_media_with_retry(
+        self, message: Message, file: Path | bytes, file_name, thumb=None
+    ):
+        """Заливка скачанного файла без отправки, с повторными попытками.
+
+        Возвращает InputMedia с атрибутами исходного сообщения, которое
+        можно отправить позже одним вызовом send_file. thumb — превью
+        документа в байтах, заливается вместе с файлом.
+        """
+        try:
+            with metrics.timer("upload"):
+                input_file = await self.scheduler.call(
+                    "upload",
+                    self.client.upload_file,
+                    file,
+                    file_name=file_name,
                 )
-            except RPCError as e:
-                logger.warning(
-                    f"Попытка {attempt + 1}: Ошибка скачивания {file_name}: {str(e)}"
+                input_thumb = None
+                if thumb:
+                    input_thumb = await self.scheduler.call(
+                        "upload",
+                        self.client.upload_file,
+                        thumb,
+                        file_name="thumb.jpg",
+                    )
+        except RPCError as e:
+            logger.warning(f"Ошибка заливки {file_name}: {str(e)}")
+            return None
+        metrics.inc("uploaded_bytes", file_size(file) + len(thumb or b""))
+        return uploaded_media(message, input_file, input_thumb)
+
+    async def stream_media_with_retry(self, message: Message, file_name):
+        """Потоковая перезаливка документа с повторными попытками"""
+        try:
+            with metrics.timer("stream"):
+                media = await self.scheduler.call(
+                    "download", self.stream_transfer.transfer, message, file_name
                 )
-            await asyncio.sleep(delay)
-        return None
+        except (RPCError, RuntimeError) as e:
+            logger.warning(
+                f"Ошибка потоковой перезаливки {file_name}: {str(e)}"
+            )
+            return None
+        metrics.inc("downloaded_bytes", message.file.size)
+        metrics.inc("uploaded_bytes", message.file.size)
+        return media
+
+    async def content_hash(self, file: Path | bytes):
+        """SHA-256 содержимого скачанного файла.
+
+        Файлы на диске читаются в отдельном потоке, файлы в памяти малы
+        и хэшируются сразу.
+        """
+        if isinstance(file, bytes):
+            return hashlib.sha256(file).hexdigest()
+        with metrics.timer("hash"):
+            return await asyncio.to_thread(_file_hash, file)
+
+    async def _send_guarded(self, guard, chat_id, file, **kwargs):
+        async with guard():
+            return await self.client.send_file(chat_id, file, **kwargs)
 
     async def send_file_with_retry(
-        self,
-        chat_id,
-        file,
-        caption="",
-        album=False,
-        reply_to=None,
-        retries=3,
-        delay=2,
+        self, chat_id, file, caption="", album=False, reply_to=None, guard=nullcontext
     ):
-        """Отправка файла с повторными попытками"""
-        for attempt in range(retries):
-            try:
-                if isinstance(file, list):
-                    for f in file:
-                        if not Path(f).exists():
-                            raise FileNotFoundError(f"Файл {f} не существует")
-                else:
-                    if not Path(file).exists():
-                        raise FileNotFoundError(f"Файл {file} не существует")
-                return await self.client.send_file(
+        """Отправка файла с повторными попытками.
+
+        guard — фабрика асинхронного контекста, в котором выполняется сам
+        запрос отправки, уже после ожидания лимитов и FloodWait.
+        """
+        # Проверяем только локальные файлы, уже залитые медиа
+        # (потоковый режим) проверять не нужно
+        for f in file if isinstance(file, list) else [file]:
+            if isinstance(f, (str, Path)) and not Path(f).exists():
+                raise FileNotFoundError(f"Файл {f} не существует")
+        try:
+            with metrics.timer("send"):
+                return await self.scheduler.call(
+                    "send",
+                    self._send_guarded,
+                    guard,
                     chat_id,
                     file,
                     caption=caption,
                     album=album,
                     reply_to=reply_to,
                 )
-            except (RPCError, FileNotFoundError) as e:
-                logger.warning(
-                    f"Попытка {attempt + 1}: Ошибка отправки: {str(e)}"
+        except RPCError as e:
+            logger.warning(f"Ошибка отправки: {str(e)}")
+            raise
+
+    async def send_media_by_reference(
+        self, chat_id, media, caption="", album=False, reply_to=None, guard=nullcontext
+    ):
+        """Переотправка медиа по серверной ссылке, без скачивания.
+
+        Возвращает None, если ссылка устарела или в источнике включена
+        защита контента — тогда медиа нужно скачать и залить заново.
+        """
+        try:
+            with metrics.timer("send"):
+                return await self.scheduler.call(
+                    "send",
+                    self._send_guarded,
+                    guard,
+                    chat_id,
+                    media,
+                    caption=caption,
+                    album=album,
+                    reply_to=reply_to,
                 )
-                if attempt == retries - 1:
-                    raise
-            await asyncio.sleep(delay)
-        raise Exception("Не удалось отправить файл после всех попыток")
+        except (ChatForwardsRestrictedError, FileReferenceExpiredError) as e:
+            logger.info(
+                f"Отправка по ссылке невозможна, нужен перезалив: {str(e)}"
+            )
+            return None
 
     async def cleanup_file(self, file_path):
         """Безопасное удаление файла с логированием"""
@@ -80,11 +250,3 @@ class FileHandler:
                 logger.warning(f"Файл не найден для удаления: {file_path}")
         except Exception as e:
             logger.error(f"Ошибка при удалении файла {file_path}: {str(e)}")
-
-    async def cleanup_temp_dir(self):
-        """Очистка всех временных файлов в папке data/"""
-        try:
-            for file_path in self.temp_dir.glob("*"):
-                await self.cleanup_file(file_path)
-        except Exception as e:
-            logger.error(f"Ошибка при очистке папки data/: {str(e)}")
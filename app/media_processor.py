@@ -1,34 +1,113 @@
 import asyncio
+from contextlib import asynccontextmanager
+from functools import partial
 from pathlib import Path
 
 from loguru import logger
-from telethon import TelegramClient
+from telethon import TelegramClient, utils
+from telethon.extensions import BinaryReader
 from telethon.tl.custom.message import Message
 from telethon.tl.types import (
     Document,
+    MessageMediaDocument,
     MessageMediaPhoto,
 )
 
 from .config import Config
 from .database import Database
-from .file_handler import FileHandler
+from .file_handler import FileHandler, file_size
+from .metrics import metrics
+from .peers import PeerCache
+from .rate_limiter import RateScheduler
+from .stream_transfer import StreamTransfer
+from .temp_storage import TempStorage
+from .transforms import MediaTransformer
+from .work_unit import PreparedMedia, PreparedUnit, WorkUnit
+
+
+def media_key(message: Message):
+    """Ключ кэша медиа: ID фото или документа на серверах Telegram.
+
+    Репост того же файла сохраняет его ID, так что повтор узнается без
+    скачивания.
+    """
+    if isinstance(message.media, MessageMediaPhoto) and message.media.photo:
+        return f"photo:{message.media.photo.id}"
+    if isinstance(message.media, MessageMediaDocument) and isinstance(
+        message.media.document, Document
+    ):
+        return f"document:{message.media.document.id}"
+    return None
+
+
+def _dump_input_media(media):
+    """Ссылка на отправленное медиа в виде байтов для кэша или None"""
+    try:
+        return bytes(utils.get_input_media(media))
+    except TypeError:
+        return None
+
+
+def _sent_copy(item: PreparedMedia, sent_message):
+    """То же медиа по ссылке на только что отправленную копию"""
+    try:
+        media = utils.get_input_media(sent_message.media)
+    except TypeError:
+        return item
+    return PreparedMedia(
+        item.message,
+        item.file_name,
+        media,
+        by_reference=True,
+        content_hash=item.content_hash,
+    )
 
 
 class MediaProcessor:
+    """Перезаливка медиа в два этапа.
+
+    prepare — скачивание и заливка файлов, может идти параллельно для
+    нескольких единиц работы. commit — отправка в группу назначения и
+    сохранение состояния, должен вызываться строго по порядку сообщений.
+
+    Медиа, которое уже было отправлено в группу назначения, берется из
+    кэша и переотправляется по ссылке без скачивания и заливки.
+
+    Между скачиванием и заливкой файл проходит через MediaTransformer,
+    если в config.transforms заданы преобразования.
+
+    worker=True — конвейер дополнительной сессии пула. Ссылки на медиа и
+    чаты действительны только для аккаунта, который их получил, поэтому
+    воркер не читает и не пополняет кэш медиа и не сохраняет чаты в базу.
+    """
+
     def __init__(
         self,
         client: TelegramClient,
         config: Config,
         db: Database,
         temp_dir: Path,
+        scheduler: RateScheduler,
+        temp_storage: TempStorage | None = None,
+        transformer: MediaTransformer | None = None,
+        worker: str | None = None,
     ):
         self.client = client
         self.config = config
         self.db = db
         self.temp_dir = temp_dir
-        self.file_handler = FileHandler(client, temp_dir)
+        # Имя сессии пула, через которую идут отправки, пишется в журнал
+        self.session_name = worker or "main"
+        self.use_media_cache = worker is None
+        self.file_handler = FileHandler(
+            client, config, db, temp_dir, scheduler, temp_storage
+        )
+        self.peers = PeerCache(client, None if worker else db, scheduler)
+        self.transformer = transformer or MediaTransformer(
+            config.transforms, config.transform_workers
+        )
 
-    def _get_file_name(self, message: Message):
+    def get_file_name(self, message: Message):
         """Получение имени файла для медиа"""
         if isinstance(message.media, MessageMediaPhoto):
             return f"photo_{message.id}.jpg"
@@ -40,131 +119,328 @@ class MediaProcessor:
                     return attr.file_name
         return f"media_{message.id}"
 
-    async def process_single_media(self, message: Message):
-        """Обработка одиночного медиа"""
-        try:
-            file_name = self._get_file_name(message)
-            file_path = await self.file_handler.download_media_with_retry(
+    def _can_copy_by_reference(self, messages: list[Message]):
+        """Можно ли переотправить медиа по ссылке, не скачивая его"""
+        if self.config.copy_mode != "reference":
+            return False
+        for message in messages:
+            # Защищенный контент нельзя пересылать даже по ссылке
+            if message.noforwards or getattr(message.chat, "noforwards", False):
+                return False
+            if not isinstance(
+                message.media, (MessageMediaPhoto, MessageMediaDocument)
+            ):
+                return False
+        return True
+
+    async def _cached_media(self, dest_chat_id, key, content_hash=None):
+        """InputMedia уже отправленной в группу назначения копии или None.
+
+        Если ссылка в кэше устарела, отправка по ней не пройдет, и _send
+        перезальет файл, а commit запомнит свежую ссылку.
+        """
+        input_media = await self.db.get_cached_media(
+            dest_chat_id, key, content_hash
+        )
+        if input_media is None:
+            return None
+        metrics.inc("media_cache_hits")
+        return BinaryReader(input_media).tgread_object()
+
+    async def _fetch_media(self, message: Message, file_name, cache_chat_id):
+        """Скачивание и заливка одного медиа без отправки.
+
+        В потоковом режиме документы заливаются сразу, минуя диск, в
+        остальных случаях через временный файл или память, место под
+        которые выделяет TempStorage. Скачанный файл сверяется с кэшем
+        по хэшу содержимого, и если такой файл уже отправлялся, заливка
+        пропускается.
+        """
+        if self.config.copy_mode == "stream" and StreamTransfer.supports(
+            message
+        ):
+            media = await self.file_handler.stream_media_with_retry(
                 message, file_name
             )
-            if not file_path:
-                logger.warning(
-                    f"Не удалось скачать медиа для сообщения {message.id}"
-                )
-                return
+            return PreparedMedia(message, file_name, media) if media else None
 
-            # Проверяем, является ли сообщение ответом
-            reply_to = None
-            if message.reply_to_msg_id:
-                reply_to = self.db.get_dest_message_id(
-                    message.reply_to_msg_id, self.config.source_chat_id
+        size = getattr(message.file, "size", None) or 0
+        async with self.file_handler.temp_storage.reserve(size, file_name) as slot:
+            file = await self.file_handler.download_media_with_retry(
+                message, file_name, slot
+            )
+            if not file:
+                return None
+            try:
+                return await self._upload_file(
+                    message, file_name, file, cache_chat_id
                 )
-                if not reply_to:
-                    logger.debug(
-                        f"Не найдено dest_message_id для reply_to_msg_id={message.reply_to_msg_id}"
-                    )
-
-            sent_message: Message = (
-                await self.file_handler.send_file_with_retry(
-                    self.config.dest_chat_id,
-                    file_path,
-                    caption=message.text or "",
-                    reply_to=reply_to,
+            finally:
+                if isinstance(file, Path):
+                    await self.file_handler.cleanup_file(file)
+
+    async def _upload_file(
+        self, message: Message, file_name, file: Path | bytes, cache_chat_id
+    ):
+        if file_size(file) == 0:
+            logger.warning(f"Файл {file_name} имеет нулевой размер, пропускаем")
+            return None
+        # Хэш нужен только кэшу медиа
+        content_hash = None
+        if cache_chat_id is not None:
+            content_hash = await self.file_handler.content_hash(file)
+            media = await self._cached_media(
+                cache_chat_id, media_key(message), content_hash
+            )
+            if media is not None:
+                return PreparedMedia(
+                    message,
+                    file_name,
+                    media,
+                    by_reference=True,
+                    content_hash=content_hash,
                 )
+        # Хэш и кэш считаются по исходному файлу, чтобы повторы узнавались
+        # независимо от преобразований
+        thumb = None
+        if self.transformer.enabled:
+            file, thumb = await self.transformer.apply(
+                file, getattr(message.file, "mime_type", None), file_name
             )
+        media = await self.file_handler.upload_media_with_retry(
+            message, file, file_name, thumb
+        )
+        if not media:
+            return None
+        return PreparedMedia(message, file_name, media, content_hash=content_hash)
+
+    async def _upload_one(
+        self, message: Message, limit: asyncio.Semaphore, cache_chat_id
+    ):
+        file_name = self.get_file_name(message)
+        key = media_key(message)
+        if cache_chat_id is not None and key:
+            media = await self._cached_media(cache_chat_id, key)
+            if media is not None:
+                return PreparedMedia(message, file_name, media, by_reference=True)
+        async with limit:
+            prepared = await self._fetch_media(message, file_name, cache_chat_id)
+        if not prepared:
+            logger.warning(f"Не удалось скачать медиа для сообщения {message.id}")
+            return None
+        return prepared
+
+    async def _upload_all(self, messages: list[Message], cache_chat_id=None):
+        """Параллельная перезаливка всех медиа единицы работы.
+
+        Порядок результатов совпадает с порядком сообщений, неудачные и
+        пустые файлы пропускаются по отдельности. Уже отправленные медиа
+        ищутся в кэше группы назначения cache_chat_id, без него все файлы
+        перезаливаются заново.
+        """
+        limit = asyncio.Semaphore(self.config.album_concurrency)
+        results = await asyncio.gather(
+            *(
+                self._upload_one(message, limit, cache_chat_id)
+                for message in messages
+            ),
+            return_exceptions=True,
+        )
+        prepared = []
+        for message, result in zip(messages, results):
+            if isinstance(result, Exception):
+                logger.error(
+                    f"Ошибка при перезаливке медиа {message.id}: {str(result)}"
+                )
+            elif result:
+                prepared.append(result)
+        return prepared
+
+    def is_synced(self, source_chat_id, message_id):
+        """Отправлено ли сообщение во все группы назначения своего источника"""
+        return all(
+            self.db.is_message_synced(message_id, source_chat_id, dest_chat_id)
+            for dest_chat_id in self.config.routes[source_chat_id]
+        )
+
+    async def prepare(self, unit: WorkUnit):
+        """Этап передачи: подготовка медиа к отправке.
+
+        Медиа скачивается и заливается один раз на все группы назначения
+        источника, кэш проверяется по первой из них.
+        """
+        cache_chat_id = None
+        if self.use_media_cache:
+            cache_chat_id = self.config.routes[unit.source_chat_id][0]
+        prepared = PreparedUnit(unit)
+        if self._can_copy_by_reference(unit.messages):
+            prepared.media = [
+                PreparedMedia(
+                    message,
+                    self.get_file_name(message),
+                    message.media,
+                    by_reference=True,
+                )
+                for message in unit.messages
+            ]
+        else:
+            prepared.media = await self._upload_all(unit.messages, cache_chat_id)
+        return prepared
 
-            self.db.save_sync_state(
-                message.id,
-                self.config.source_chat_id,
-                sent_message.id,
-                file_name,
+    async def _get_reply_to(self, message: Message, source_chat_id, dest_chat_id):
+        """Поиск сообщения в группе назначения, на которое нужно ответить"""
+        if not message.reply_to_msg_id:
+            return None
+        reply_to = await self.db.get_dest_message_id(
+            message.reply_to_msg_id, source_chat_id, dest_chat_id
+        )
+        if not reply_to:
+            logger.debug(
+                f"Не найдено dest_message_id для reply_to_msg_id={message.reply_to_msg_id}"
             )
-            self.db.update_last_processed_id(
-                self.config.source_chat_id, message.id
+        return reply_to
+
+    @asynccontextmanager
+    async def _sending(self, prepared: PreparedUnit, dest_chat_id):
+        """Запись sending в журнал прямо перед запросом отправки.
+
+        В sending попадают только отправляемые сообщения: не скачанные
+        члены медиагруппы в пост не войдут. Пока запрос не завершится,
+        другие отправки в эту группу назначения ждут, так что посты этой
+        отправки окажутся сразу после dest_max_id из журнала.
+        """
+        unit = prepared.unit
+        async with self.db.dest_lock(dest_chat_id):
+            await self.db.journal_set_state(
+                unit.source_chat_id,
+                [item.message.id for item in prepared.media],
+                "sending",
+                dest_chat_id,
+                unit.caption,
+                self.session_name,
             )
+            yield
 
-            logger.info(f"Синхронизировано: {file_name} (id: {message.id})")
+    async def _send(self, prepared: PreparedUnit, dest_chat_id, reply_to):
+        unit = prepared.unit
+        peer = await self.peers.resolve(dest_chat_id)
+        album = unit.grouped_id is not None
+        media = [item.media for item in prepared.media]
+        file = media if album else media[0]
+        guard = partial(self._sending, prepared, dest_chat_id)
+        if any(item.by_reference for item in prepared.media):
+            sent = await self.file_handler.send_media_by_reference(
+                peer,
+                file,
+                caption=unit.caption,
+                album=album,
+                reply_to=reply_to,
+                guard=guard,
+            )
+            if sent is not None:
+                return sent
+            # Ссылка устарела или включена защита — перезаливаем файлы
+            prepared.media = await self._upload_all(unit.messages)
+            if not prepared.media:
+                return None
+            media = [item.media for item in prepared.media]
+            file = media if album else media[0]
+        return await self.file_handler.send_file_with_retry(
+            peer,
+            file,
+            caption=unit.caption,
+            album=album,
+            reply_to=reply_to,
+            guard=guard,
+        )
 
-            await self.file_handler.cleanup_file(file_path)
+    async def _commit_to(self, prepared: PreparedUnit, dest_chat_id, finished):
+        """Отправка единицы работы в одну группу назначения.
 
-        except Exception as e:
-            logger.error(f"Ошибка при обработке медиа {message.id}: {str(e)}")
+        Возвращает пары (PreparedMedia, отправленное сообщение) или None,
+        если отправить не удалось.
+        """
+        unit = prepared.unit
+        # Проверяем, является ли первое сообщение ответом
+        reply_to = await self._get_reply_to(
+            unit.messages[0], unit.source_chat_id, dest_chat_id
+        )
+        sent_messages = await self._send(prepared, dest_chat_id, reply_to)
+        if sent_messages is None:
+            return None
+        if not isinstance(sent_messages, list):
+            sent_messages = [sent_messages]
 
-    async def process_media_group(
-        self, messages: list[Message], caption, grouped_id
-    ):
-        """Обработка медиагруппы"""
-        files = []
-        file_names = []
-        try:
-            for message in messages:
-                file_name = self._get_file_name(message)
-                file_path = await self.file_handler.download_media_with_retry(
-                    message, file_name
+        synced = list(zip(prepared.media, sent_messages))
+        metrics.inc("synced_messages", len(synced))
+        await self.db.save_synced(
+            unit.source_chat_id,
+            dest_chat_id,
+            [
+                (item.message.id, sent_message.id, item.file_name)
+                for item, sent_message in synced
+            ],
+            finished,
+        )
+        for item, sent_message in synced:
+            key = media_key(item.message) or item.content_hash
+            input_media = _dump_input_media(sent_message.media)
+            if key and input_media and self.use_media_cache:
+                await self.db.cache_media(
+                    dest_chat_id,
+                    key,
+                    item.content_hash,
+                    sent_message.id,
+                    input_media,
+                )
+            if unit.grouped_id:
+                logger.info(
+                    f"Синхронизировано (группа) в {dest_chat_id}: {item.file_name} (id: {item.message.id})"
                 )
-                if not file_path:
-                    logger.warning(
-                        f"Не удалось скачать медиа для сообщения {message.id}"
-                    )
-                    continue
-                if file_path.stat().st_size == 0:
-                    logger.warning(
-                        f"Файл {file_name} имеет нулевой размер, пропускаем"
-                    )
-                    await self.file_handler.cleanup_file(file_path)
-                    continue
-                files.append(file_path)
-                file_names.append(file_name)
-                await asyncio.sleep(0.5)
-
-            if files:
-                # Проверяем, является ли первое сообщение группы ответом
-                reply_to = None
-                first_message = messages[0]
-                if first_message.reply_to_msg_id:
-                    reply_to = self.db.get_dest_message_id(
-                        first_message.reply_to_msg_id,
-                        self.config.source_chat_id,
-                    )
-                    if not reply_to:
-                        logger.debug(
-                            f"Не найдено dest_message_id для reply_to_msg_id={first_message.reply_to_msg_id}"
-                        )
-
-                sent_messages = await self.file_handler.send_file_with_retry(
-                    self.config.dest_chat_id,
-                    files,
-                    caption=caption,
-                    album=True,
-                    reply_to=reply_to,
+            else:
+                logger.info(
+                    f"Синхронизировано в {dest_chat_id}: {item.file_name} (id: {item.message.id})"
                 )
-                sent_messages = (
-                    sent_messages
-                    if isinstance(sent_messages, list)
-                    else [sent_messages]
+        return synced
+
+    async def commit(self, prepared: PreparedUnit):
+        """Этап отправки: публикация во всех группах назначения и сохранение
+        состояния.
+
+        Файлы заливаются один раз: в первую группу назначения уходит
+        подготовленное медиа, в остальные — ссылки на только что
+        отправленные копии. Группы, куда единица работы уже попала при
+        прошлой попытке, пропускаются. Возвращает ID исходных сообщений,
+        синхронизированных во все группы.
+        """
+        unit = prepared.unit
+        if not prepared.media:
+            logger.warning(f"Нет медиа для отправки в сообщениях {unit.first_id}")
+            return []
+
+        dests = [
+            dest_chat_id
+            for dest_chat_id in self.config.routes[unit.source_chat_id]
+            if not all(
+                self.db.is_message_synced(
+                    message.id, unit.source_chat_id, dest_chat_id
                 )
+                for message in unit.messages
+            )
+        ]
+        if not dests:
+            await self.db.journal_finish(
+                unit.source_chat_id, [message.id for message in unit.messages]
+            )
+            return [message.id for message in unit.messages]
 
-                for message, sent_message, file_name in zip(
-                    messages, sent_messages, file_names
-                ):
-                    self.db.save_sync_state(
-                        message.id,
-                        self.config.source_chat_id,
-                        sent_message.id,
-                        file_name,
-                    )
-                    self.db.update_last_processed_id(
-                        self.config.source_chat_id, message.id
-                    )
-                    logger.info(
-                        f"Синхронизировано (группа): {file_name} (id: {message.id})"
-                    )
-
-        except Exception as e:
-            logger.error(
-                f"Ошибка при синхронизации медиагруппы {grouped_id}: {str(e)}"
+        for index, dest_chat_id in enumerate(dests):
+            synced = await self._commit_to(
+                prepared, dest_chat_id, finished=index == len(dests) - 1
             )
-        finally:
-            for file_path in files:
-                await self.file_handler.cleanup_file(file_path)
-            await self.file_handler.cleanup_temp_dir()
+            if synced is None:
+                return []
+            prepared.media = [
+                _sent_copy(item, sent_message) for item, sent_message in synced
+            ]
+        return [item.message.id for item in prepared.media]
@@ -0,0 +1,134 @@
+import asyncio
+import time
+from contextlib import contextmanager, nullcontext
+
+from loguru import logger
+
+_NULL_TIMER = nullcontext()
+
+
+class Metrics:
+    """Счетчики и тайминги этапов перезаливки.
+
+    Один общий экземпляр metrics на весь бот, по аналогии с logger.
+    Пока метрики не включены через configure, все методы сразу
+    возвращаются и почти ничего не стоят.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.counters: dict[str, float] = {}
+        self.gauges: dict[str, float] = {}
+        # stage -> [количество, сумма секунд, максимум секунд]
+        self.timings: dict[str, list[float]] = {}
+
+    def configure(self, enabled):
+        self.enabled = enabled
+
+    def inc(self, name, value=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        if not self.enabled:
+            return
+        self.gauges[name] = value
+
+    def observe(self, stage, seconds):
+        if not self.enabled:
+            return
+        timing = self.timings.get(stage)
+        if timing is None:
+            self.timings[stage] = [1, seconds, seconds]
+        else:
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    @contextmanager
+    def _timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def timer(self, stage):
+        """Контекстный менеджер, замеряющий длительность этапа"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return self._timer(stage)
+
+    def render(self):
+        """Метрики в текстовом формате Prometheus"""
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE copycat_{name}_total counter")
+            lines.append(f"copycat_{name}_total {value}")
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f"# TYPE copycat_{name} gauge")
+            lines.append(f"copycat_{name} {value}")
+        timings = sorted(self.timings.items())
+        if timings:
+            lines.append("# TYPE copycat_stage_seconds summary")
+        for stage, (count, total, _) in timings:
+            lines.append(f'copycat_stage_seconds_count{{stage="{stage}"}} {count}')
+            lines.append(f'copycat_stage_seconds_sum{{stage="{stage}"}} {total}')
+        # Максимум не входит в summary, поэтому отдается отдельным gauge
+        if timings:
+            lines.append("# TYPE copycat_stage_max_seconds gauge")
+        for stage, (_, _, maximum) in timings:
+            lines.append(f'copycat_stage_max_seconds{{stage="{stage}"}} {maximum}')
+        return "\n".join(lines) + "\n"
+
+    async def _handle_request(self, reader, writer):
+        try:
+            await reader.readline()
+            body = self.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode()
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, port, host="127.0.0.1"):
+        """Локальный HTTP-эндпоинт с метриками для Prometheus"""
+        server = await asyncio.start_server(self._handle_request, host, port)
+        logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+        return server
+
+    def _summary(self, previous: dict[str, float], interval):
+        parts = []
+        for label, name in (
+            ("скачивание", "downloaded_bytes"),
+            ("заливка", "uploaded_bytes"),
+        ):
+            delta = self.counters.get(name, 0) - previous.get(name, 0)
+            parts.append(f"{label}={delta / interval / 1024 / 1024:.2f} МБ/с")
+        for name in ("synced_messages", "retries", "flood_waits"):
+            parts.append(f"{name}={self.counters.get(name, 0):g}")
+        if "transform_saved_bytes" in self.counters:
+            saved = self.counters["transform_saved_bytes"] / 1024 / 1024
+            parts.append(f"сэкономлено преобразованиями={saved:.1f} МБ")
+        for name, value in sorted(self.gauges.items()):
+            parts.append(f"{name}={value:g}")
+        for stage, (count, total, _) in sorted(self.timings.items()):
+            parts.append(f"{stage}={total / count:.2f}с×{count}")
+        return ", ".join(parts)
+
+    async def log_periodically(self, interval):
+        """Периодическая сводка метрик в лог"""
+        previous = dict(self.counters)
+        while True:
+            await asyncio.sleep(interval)
+            logger.info(f"Метрики: {self._summary(previous, interval)}")
+            previous = dict(self.counters)
+
+
+metrics = Metrics()
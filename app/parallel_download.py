@@ -0,0 +1,186 @@
+import asyncio
+from pathlib import Path
+
+from loguru import logger
+from telethon import TelegramClient, utils
+from telethon.network import MTProtoSender
+from telethon.tl import functions
+from telethon.tl.alltlobjects import LAYER
+from telethon.tl.custom.message import Message
+from telethon.tl.types import Document
+from telethon.tl.types.upload import File
+
+from .database import Database
+from .rate_limiter import RateScheduler
+from .resumable_download import PROGRESS_EVERY_CHUNKS, ResumableDownloader
+from .stream_transfer import PART_SIZE
+
+
+class ParallelDownloader(ResumableDownloader):
+    """Скачивание большого документа по диапазонам через несколько соединений.
+
+    Файл заранее создается нужного размера, каждый диапазон качается
+    своим MTProtoSender к DC файла и пишется по своему смещению. Прогресс
+    каждого диапазона хранится в download_progress под ключом с его
+    границами, так что докачка после обрыва работает так же, как у
+    ResumableDownloader, а после смены parallel_parts диапазоны качаются
+    заново. Файл создан сразу полного размера, поэтому готовность
+    проверяется по каждому диапазону, а не по размеру файла.
+    """
+
+    def __init__(
+        self,
+        client: TelegramClient,
+        scheduler: RateScheduler,
+        db: Database,
+        temp_dir: Path,
+        parts=4,
+    ):
+        super().__init__(client, scheduler, db, temp_dir)
+        self.parts = max(1, parts)
+        # Ключи авторизации в чужих DC, чтобы не экспортировать их заново
+        self._auth_keys = {}
+
+    async def _create_sender(self, dc_id):
+        dc = await self.client._get_dc(dc_id)
+        if dc_id == self.client.session.dc_id:
+            auth_key = self.client.session.auth_key
+        else:
+            auth_key = self._auth_keys.get(dc_id)
+        sender = MTProtoSender(auth_key, loggers=self.client._log)
+        await sender.connect(
+            self.client._connection(
+                dc.ip_address,
+                dc.port,
+                dc.id,
+                loggers=self.client._log,
+                proxy=self.client._proxy,
+                local_addr=self.client._local_addr,
+            )
+        )
+        if auth_key is None:
+            auth = await self.client(
+                functions.auth.ExportAuthorizationRequest(dc_id)
+            )
+            self.client._init_request.query = (
+                functions.auth.ImportAuthorizationRequest(
+                    id=auth.id, bytes=auth.bytes
+                )
+            )
+            await sender.send(
+                functions.InvokeWithLayerRequest(
+                    LAYER, self.client._init_request
+                )
+            )
+            self._auth_keys[dc_id] = sender.auth_key
+        return sender
+
+    def _ranges(self, size):
+        """Диапазоны (start, end), выровненные по размеру куска"""
+        chunks = (size + PART_SIZE - 1) // PART_SIZE
+        per_part = (chunks + self.parts - 1) // self.parts
+        ranges = []
+        for index in range(self.parts):
+            start = index * per_part * PART_SIZE
+            end = min(size, (index + 1) * per_part * PART_SIZE)
+            if start < end:
+                ranges.append((start, end))
+        return ranges
+
+    async def _range_done(self, range_key, total_size, length):
+        progress = await self.db.get_download_progress(range_key)
+        if not progress or progress[1] != total_size:
+            return 0
+        done = min(progress[2], length)
+        return done if done == length else done - done % PART_SIZE
+
+    async def _download_range(
+        self, sender, location, path: Path, file_key, total_size, index, start, end
+    ):
+        range_key = f"{file_key}:{start}-{end}"
+        offset = start + await self._range_done(
+            range_key, total_size, end - start
+        )
+        chunks = 0
+        with open(path, "r+b") as f:
+            try:
+                while offset < end:
+                    result = await self.scheduler.call(
+                        "download_part",
+                        sender.send,
+                        functions.upload.GetFileRequest(
+                            location, offset=offset, limit=PART_SIZE
+                        ),
+                    )
+                    if not isinstance(result, File):
+                        raise RuntimeError(
+                            "Файл отдается через CDN, диапазонное скачивание недоступно"
+                        )
+                    if not result.bytes:
+                        break
+                    data = result.bytes[: end - offset]
+                    f.seek(offset)
+                    f.write(data)
+                    offset += len(data)
+                    chunks += 1
+                    if chunks % PROGRESS_EVERY_CHUNKS == 0:
+                        f.flush()
+                        await self.db.save_download_progress(
+                            range_key, str(path), total_size, offset - start
+                        )
+            finally:
+                f.flush()
+                await self.db.save_download_progress(
+                    range_key, str(path), total_size, offset - start
+                )
+        if offset < end:
+            raise RuntimeError(f"Диапазон {index} скачан не полностью")
+        return True
+
+    async def _download_chunks(self, message: Message, path: Path):
+        document: Document = message.media.document
+        file_key = self.file_key(document)
+        ranges = self._ranges(document.size)
+
+        if not path.exists() or path.stat().st_size != document.size:
+            # Новый файл: создаем его сразу нужного размера
+            with open(path, "wb") as f:
+                f.truncate(document.size)
+            await self.db.clear_download_progress(file_key)
+
+        dc_id, location = utils.get_input_location(document)
+        senders = []
+        try:
+            # Соединения создаются по очереди: экспорт авторизации в чужой DC
+            # меняет общий client._init_request
+            for _ in ranges:
+                senders.append(await self._create_sender(dc_id))
+            logger.info(
+                f"Скачивание {path.name} в {len(senders)} соединений к DC {dc_id}"
+            )
+            done = await asyncio.gather(
+                *(
+                    self._download_range(
+                        sender,
+                        location,
+                        path,
+                        file_key,
+                        document.size,
+                        index,
+                        start,
+                        end,
+                    )
+                    for index, (sender, (start, end)) in enumerate(
+                        zip(senders, ranges)
+                    )
+                )
+            )
+        finally:
+            await asyncio.gather(
+                *(sender.disconnect() for sender in senders),
+                return_exceptions=True,
+            )
+
+        if not all(done):
+            raise RuntimeError(f"{path.name} скачан не полностью")
+        await self.db.clear_download_progress(file_key)
@@ -0,0 +1,94 @@
+from loguru import logger
+from telethon import TelegramClient, utils
+from telethon.tl.custom.message import Message
+from telethon.tl.types import (
+    InputPeerChannel,
+    InputPeerChat,
+    InputPeerUser,
+    PeerChannel,
+    PeerChat,
+    PeerUser,
+)
+
+from .database import Database
+from .rate_limiter import RateScheduler
+
+PEER_TYPES = {
+    InputPeerChannel: "channel",
+    InputPeerChat: "chat",
+    InputPeerUser: "user",
+}
+
+
+def is_user_message(message: Message):
+    """Сообщение от пользователя, а не от группы или канала.
+
+    Тип отправителя берется из from_id, который приходит вместе с
+    сообщением, поэтому проверка не требует загрузки отправителя.
+    """
+    return message.is_private or isinstance(message.from_id, PeerUser)
+
+
+class PeerCache:
+    """Разрешенные InputPeer источников и групп назначения.
+
+    Каждый чат разрешается один раз, тип и access_hash сохраняются в
+    Database, так что после перезапуска запросы к Telegram не нужны.
+    В send_file и iter_messages уходит готовый InputPeer вместо ID,
+    который Telethon иначе каждый раз искал бы в кэше сессии.
+
+    access_hash у каждого аккаунта свой, поэтому в базе хранятся только
+    чаты основной сессии, а воркеры пула сессий создаются с db=None и
+    помнят разрешенные чаты до перезапуска.
+    """
+
+    def __init__(
+        self,
+        client: TelegramClient,
+        db: Database | None,
+        scheduler: RateScheduler,
+    ):
+        self.client = client
+        self.db = db
+        self.scheduler = scheduler
+        self._peers = {}
+
+    @staticmethod
+    def _from_saved(peer_id, peer_type, access_hash):
+        real_id, peer_class = utils.resolve_id(peer_id)
+        if peer_type == "channel" and peer_class is PeerChannel:
+            return InputPeerChannel(real_id, access_hash)
+        if peer_type == "chat" and peer_class is PeerChat:
+            return InputPeerChat(real_id)
+        if peer_type == "user" and peer_class is PeerUser:
+            return InputPeerUser(real_id, access_hash)
+        return None
+
+    async def resolve(self, peer_id):
+        """InputPeer для ID чата, при первом обращении из базы или Telegram"""
+        peer = self._peers.get(peer_id)
+        if peer is not None:
+            return peer
+        saved = self.db.get_peer(peer_id) if self.db else None
+        if saved:
+            peer = self._from_saved(peer_id, *saved)
+        if peer is None:
+            peer = await self.scheduler.call(
+                "scan", self.client.get_input_entity, peer_id
+            )
+            peer_type = PEER_TYPES.get(type(peer))
+            if peer_type and self.db:
+                await self.db.save_peer(
+                    peer_id, peer_type, getattr(peer, "access_hash", 0)
+                )
+        self._peers[peer_id] = peer
+        return peer
+
+    async def warm(self, peer_ids):
+        """Разрешение всех чатов маршрутов заранее, при запуске"""
+        for peer_id in peer_ids:
+            try:
+                await self.resolve(peer_id)
+            except (ValueError, TypeError) as e:
+                logger.error(f"Не удалось найти чат {peer_id}: {str(e)}")
+                raise
@@ -0,0 +1,182 @@
+import asyncio
+import random
+from typing import AsyncIterator, Callable
+
+from loguru import logger
+from telethon.errors import FloodError, ServerError, TimedOutError
+
+from .metrics import metrics
+
+# Запросов в секунду по типам операций, если в config.json не указано иное
+DEFAULT_RATE_LIMITS = {
+    "scan": 3.0,
+    # Скан бэклога через takeout-сессию, у нее лимиты мягче
+    "takeout_scan": 10.0,
+    "download": 10.0,
+    "download_part": 100.0,
+    "upload": 10.0,
+    "upload_part": 100.0,
+    "send": 1.0,
+}
+
+# Ошибки, после которых имеет смысл повторить запрос
+TRANSIENT_ERRORS = (
+    ServerError,
+    TimedOutError,
+    ConnectionError,
+    asyncio.TimeoutError,
+)
+
+# Признак конца итератора в RateScheduler.iterate
+_END = object()
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = None
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if self._updated is not None:
+                    self._tokens = min(
+                        self.capacity,
+                        self._tokens + (now - self._updated) * self.rate,
+                    )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class RateScheduler:
+    """Единая точка для всех запросов к Telegram.
+
+    У каждого типа операций свой token bucket. FloodWait от сервера
+    ставит на паузу все операции сразу на запрошенное время, а временные
+    ошибки повторяются с экспоненциальной задержкой и случайным разбросом.
+    Лимиты и FloodWait у каждого аккаунта свои, поэтому у каждой сессии
+    свой RateScheduler, name попадает в логи.
+    """
+
+    def __init__(
+        self,
+        rate_limits=None,
+        max_retries=5,
+        base_delay=1.0,
+        max_delay=60.0,
+        name=None,
+    ):
+        limits = DEFAULT_RATE_LIMITS | (rate_limits or {})
+        self._buckets = {op: TokenBucket(rate) for op, rate in limits.items()}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._flood_until = 0.0
+        self._log_prefix = f"[{name}] " if name else ""
+
+    def _backoff(self, attempt):
+        metrics.inc("retries")
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
+
+    async def _wait_flood(self):
+        loop = asyncio.get_running_loop()
+        while (remaining := self._flood_until - loop.time()) > 0:
+            await asyncio.sleep(remaining)
+
+    def _on_flood(self, op, error: FloodError):
+        seconds = getattr(error, "seconds", None) or self.base_delay
+        metrics.inc("flood_waits")
+        metrics.inc("flood_wait_seconds", seconds)
+        loop = asyncio.get_running_loop()
+        # Небольшой запас, чтобы не попасть в FloodWait повторно
+        until = loop.time() + seconds + random.uniform(0.5, 1.5)
+        if until > self._flood_until:
+            self._flood_until = until
+            logger.warning(
+                f"{self._log_prefix}FloodWait {seconds} с на операции {op}, пауза"
+            )
+
+    def flood_remaining(self):
+        """Сколько секунд еще длится пауза после FloodWait, 0 если ее нет"""
+        loop = asyncio.get_running_loop()
+        return max(0.0, self._flood_until - loop.time())
+
+    async def acquire(self, op):
+        await self._wait_flood()
+        await self._buckets[op].acquire()
+
+    async def call(self, op, func: Callable, *args, **kwargs):
+        """Вызов func с лимитами и повторами для операции op"""
+        attempt = 0
+        while True:
+            await self.acquire(op)
+            try:
+                return await func(*args, **kwargs)
+            except FloodError as e:
+                # FloodWait не считается попыткой, сервер сам сказал, сколько ждать
+                self._on_flood(op, e)
+            except TRANSIENT_ERRORS as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(
+                    f"Попытка {attempt}: временная ошибка {op}: {str(e)}, повтор через {delay:.1f} с"
+                )
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    async def _next(iterator):
+        try:
+            return await iterator.__anext__()
+        except StopAsyncIteration:
+            return _END
+
+    async def iterate(
+        self, op, make_iter: Callable[[object], AsyncIterator], page_size=100
+    ):
+        """Обход постраничного итератора с лимитами и продолжением после ошибок.
+
+        make_iter получает последний выданный элемент (или None) и должен
+        вернуть итератор, продолжающий обход сразу после него.
+        """
+        last = None
+        attempt = 0
+        while True:
+            iterator = make_iter(last).__aiter__()
+            count = 0
+            try:
+                while True:
+                    # Новая страница запрашивается на каждом page_size-м элементе
+                    if count % page_size == 0:
+                        await self.acquire(op)
+                        with metrics.timer(op):
+                            item = await self._next(iterator)
+                    else:
+                        item = await self._next(iterator)
+                    if item is _END:
+                        return
+                    count += 1
+                    last = item
+                    attempt = 0
+                    yield item
+            except FloodError as e:
+                self._on_flood(op, e)
+            except TRANSIENT_ERRORS as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(
+                    f"Попытка {attempt}: временная ошибка {op}: {str(e)}, повтор через {delay:.1f} с"
+                )
+                await asyncio.sleep(delay)
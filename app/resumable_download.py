@@ -0,0 +1,164 @@
+import asyncio
+import os
+import shutil
+from pathlib import Path
+
+from loguru import logger
+from telethon import TelegramClient
+from telethon.tl.custom.message import Message
+from telethon.tl.types import Document
+
+from .database import Database
+from .rate_limiter import RateScheduler
+from .stream_transfer import PART_SIZE
+
+# Прогресс сохраняется в базу каждые столько кусков
+PROGRESS_EVERY_CHUNKS = 8
+# Недокачанный файл без прогресса дольше этого срока удаляется при запуске
+PARTIAL_MAX_AGE = 24 * 60 * 60
+
+
+class ResumableDownloader:
+    """Докачка больших документов кусками по смещению.
+
+    Файл пишется в temp/<id документа>.part, а число скачанных байт
+    сохраняется в таблицу download_progress. Повторная попытка или
+    перезапущенный бот продолжают с последнего сохраненного куска.
+
+    Готовый файл переносится в путь задачи из TempStorage. Если тот же
+    документ (репост) одновременно нужен нескольким задачам, качает его
+    одна, остальные ждут и получают жесткую ссылку или копию файла.
+    """
+
+    # .part файл -> (путь, future) задач, ждущих того же документа. Общий
+    # для всех сессий пула: временная папка у них одна
+    _active: dict[Path, list[tuple[Path, asyncio.Future]]] = {}
+
+    def __init__(
+        self,
+        client: TelegramClient,
+        scheduler: RateScheduler,
+        db: Database,
+        temp_dir: Path,
+    ):
+        self.client = client
+        self.scheduler = scheduler
+        self.db = db
+        self.temp_dir = temp_dir
+
+    @staticmethod
+    def file_key(document: Document):
+        return f"document:{document.id}"
+
+    def partial_path(self, document: Document):
+        return self.temp_dir / f"{document.id}.part"
+
+    async def remove_stale(self):
+        """Удаление .part файлов, которые уже не будут докачаны.
+
+        Задачи, ушедшие в dead_letter или удаленные из источника, оставляют
+        .part файл и прогресс в базе. Вызывается при запуске, пока ни одна
+        задача еще не качает.
+        """
+        active = {
+            Path(path)
+            for path in await self.db.expire_download_progress(PARTIAL_MAX_AGE)
+        }
+        for part in self.temp_dir.glob("*.part"):
+            if part in active:
+                continue
+            try:
+                part.unlink()
+                logger.info(f"Удален недокачанный файл: {part}")
+            except OSError as e:
+                logger.error(f"Ошибка при удалении файла {part}: {str(e)}")
+
+    async def _resume_offset(self, file_key, path: Path, total_size):
+        progress = await self.db.get_download_progress(file_key)
+        if not progress or not path.exists():
+            return 0
+        _, saved_size, downloaded = progress
+        if saved_size != total_size:
+            return 0
+        # На диске могло оказаться больше, чем записано в базу, но не меньше
+        downloaded = min(downloaded, path.stat().st_size)
+        return downloaded - downloaded % PART_SIZE
+
+    async def _download_chunks(self, message: Message, path: Path):
+        document: Document = message.media.document
+        file_key = self.file_key(document)
+        offset = await self._resume_offset(file_key, path, document.size)
+        if offset:
+            logger.info(
+                f"Докачка {path.name} с {offset} из {document.size} байт"
+            )
+
+        with open(path, "r+b" if offset else "wb") as f:
+            f.truncate(offset)
+            f.seek(offset)
+            chunks = 0
+            try:
+                async for chunk in self.client.iter_download(
+                    document,
+                    offset=offset,
+                    request_size=PART_SIZE,
+                    file_size=document.size,
+                ):
+                    f.write(chunk)
+                    offset += len(chunk)
+                    chunks += 1
+                    if chunks % PROGRESS_EVERY_CHUNKS == 0:
+                        f.flush()
+                        await self.db.save_download_progress(
+                            file_key, str(path), document.size, offset
+                        )
+            finally:
+                f.flush()
+                await self.db.save_download_progress(
+                    file_key, str(path), document.size, offset
+                )
+
+    @staticmethod
+    def _share(part: Path, path: Path):
+        try:
+            os.link(part, path)
+        except OSError:
+            # Файловая система без жестких ссылок
+            shutil.copyfile(part, path)
+
+    async def download(self, message: Message, path: Path):
+        """Скачивание документа с докачкой в path, возвращает path"""
+        document: Document = message.media.document
+        file_key = self.file_key(document)
+        part = self.partial_path(document)
+        while (waiters := self._active.get(part)) is not None:
+            done = asyncio.get_running_loop().create_future()
+            waiters.append((path, done))
+            # False — скачивание не удалось, пробуем сами
+            if await done:
+                return path
+
+        waiters = self._active[part] = []
+        try:
+            await self.scheduler.call(
+                "download", self._download_chunks, message, part
+            )
+
+            # Перед заливкой убеждаемся, что файл скачан целиком
+            size = part.stat().st_size
+            await self.db.clear_download_progress(file_key)
+            if size != document.size:
+                part.unlink(missing_ok=True)
+                raise RuntimeError(
+                    f"Размер {part.name} {size} байт, ожидалось {document.size}"
+                )
+            for waiter_path, done in waiters:
+                self._share(part, waiter_path)
+                done.set_result(True)
+            part.replace(path)
+        finally:
+            del self._active[part]
+            for _, done in waiters:
+                if not done.done():
+                    done.set_result(False)
+        return path
@@ -0,0 +1,111 @@
+from loguru import logger
+from telethon import TelegramClient
+
+from .media_processor import MediaProcessor
+from .rate_limiter import RateScheduler
+from .work_unit import PreparedUnit, WorkUnit
+
+
+class PoolSession:
+    """Аккаунт Telegram в пуле со своими лимитами и конвейером перезаливки.
+
+    Единица работы целиком, от скачивания до отправки, проходит через
+    одну сессию: залитые файлы и access_hash принадлежат аккаунту,
+    который их получил.
+    """
+
+    def __init__(
+        self,
+        name,
+        client: TelegramClient,
+        scheduler: RateScheduler,
+        media_processor: MediaProcessor,
+        main=False,
+    ):
+        self.name = name
+        self.client = client
+        self.scheduler = scheduler
+        self.media_processor = media_processor
+        # Основная сессия сканирует источники, сообщения уже получены ею
+        self.main = main
+        # Сколько единиц работы сессия сейчас скачивает или отправляет
+        self.active = 0
+
+    async def _own_unit(self, unit: WorkUnit):
+        """Те же сообщения, полученные через эту сессию.
+
+        Сообщения из скана основной сессии несут ее ссылки на файлы,
+        воркер получает их заново по ID. Удаленные сообщения выпадают.
+        """
+        if self.main:
+            return unit
+        peer = await self.media_processor.peers.resolve(unit.source_chat_id)
+        messages = await self.scheduler.call(
+            "scan",
+            self.client.get_messages,
+            peer,
+            ids=[message.id for message in unit.messages],
+        )
+        return WorkUnit(
+            unit.source_chat_id,
+            [message for message in messages if message and message.media],
+            unit.grouped_id,
+            unit.live,
+        )
+
+    async def prepare(self, unit: WorkUnit):
+        unit = await self._own_unit(unit)
+        if not unit.messages:
+            return PreparedUnit(unit)
+        return await self.media_processor.prepare(unit)
+
+
+class SessionPool:
+    """Основная сессия и дополнительные аккаунты-воркеры.
+
+    Каждая единица работы достается наименее загруженной сессии, которая
+    не стоит на паузе после FloodWait. Сессия на паузе выпадает из
+    ротации, пока пауза не кончится; если на паузе все, выбирается та,
+    что освободится раньше. Единицы работы, уже взятые сессией, ждут
+    конца ее паузы. Порядок отправки от выбора сессии не зависит, его
+    держит SyncEngine.
+    """
+
+    def __init__(self, main: PoolSession):
+        self.main = main
+        self.sessions = [main]
+
+    def add(self, session: PoolSession):
+        self.sessions.append(session)
+
+    def get(self, name):
+        """Сессия пула по имени или None"""
+        return next((s for s in self.sessions if s.name == name), None)
+
+    async def warm(self, chat_ids):
+        """Разрешение чатов маршрутов во всех сессиях.
+
+        Основная сессия без доступа к чату останавливает бота, воркер
+        просто исключается из пула.
+        """
+        await self.main.media_processor.peers.warm(chat_ids)
+        for session in self.sessions[1:]:
+            try:
+                await session.media_processor.peers.warm(chat_ids)
+            except (ValueError, TypeError):
+                logger.error(
+                    f"Сессия {session.name} не видит чаты маршрутов и исключена из пула"
+                )
+                self.sessions.remove(session)
+        logger.info(f"Сессий в пуле: {len(self.sessions)}")
+
+    def acquire(self):
+        session = min(
+            self.sessions,
+            key=lambda s: (s.scheduler.flood_remaining(), s.active),
+        )
+        session.active += 1
+        return session
+
+    def release(self, session: PoolSession):
+        session.active -= 1
@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import os
+
+from loguru import logger
+from telethon import TelegramClient
+from telethon.tl import functions
+from telethon.tl.custom.message import Message
+from telethon.tl.types import (
+    Document,
+    InputFile,
+    InputFileBig,
+    InputMediaUploadedDocument,
+    InputMediaUploadedPhoto,
+    MessageMediaDocument,
+    MessageMediaPhoto,
+)
+
+from .rate_limiter import RateScheduler
+
+# Размер куска совпадает для скачивания и заливки, максимум для обоих API
+PART_SIZE = 512 * 1024
+# Файлы больше этого размера Telegram принимает только через SaveBigFilePart
+BIG_FILE_SIZE = 10 * 1024 * 1024
+
+
+def uploaded_media(message: Message, input_file, thumb=None):
+    """InputMedia для залитого файла с атрибутами исходного сообщения.
+
+    thumb — залитое превью, применяется только к документам.
+    """
+    if isinstance(message.media, MessageMediaPhoto):
+        return InputMediaUploadedPhoto(file=input_file)
+    document = getattr(message.media, "document", None)
+    if isinstance(document, Document):
+        return InputMediaUploadedDocument(
+            file=input_file,
+            mime_type=document.mime_type,
+            attributes=document.attributes,
+            thumb=thumb,
+        )
+    return input_file
+
+
+class StreamTransfer:
+    """Перезаливка документа без записи на диск.
+
+    Куски из iter_download складываются в ограниченную очередь и сразу
+    заливаются частями файла, так что скачивание и заливка идут параллельно,
+    а в памяти одновременно лежит не больше buffer_chunks кусков.
+    """
+
+    def __init__(
+        self,
+        client: TelegramClient,
+        scheduler: RateScheduler,
+        buffer_chunks: int = 8,
+    ):
+        self.client = client
+        self.scheduler = scheduler
+        self.buffer_chunks = buffer_chunks
+
+    @staticmethod
+    def supports(message: Message):
+        """Потоковая перезаливка поддерживается только для документов"""
+        return isinstance(message.media, MessageMediaDocument) and isinstance(
+            message.media.document, Document
+        )
+
+    async def _download(self, document: Document, queue: asyncio.Queue):
+        try:
+            async for chunk in self.client.iter_download(
+                document, request_size=PART_SIZE, file_size=document.size
+            ):
+                await queue.put(bytes(chunk))
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(None)
+
+    async def _upload(self, file_id, size, queue: asyncio.Queue):
+        is_big = size > BIG_FILE_SIZE
+        part_count = (size + PART_SIZE - 1) // PART_SIZE
+        hash_md5 = hashlib.md5()
+        part_index = 0
+        while True:
+            part = await queue.get()
+            if part is None:
+                break
+            if isinstance(part, Exception):
+                raise part
+            if is_big:
+                request = functions.upload.SaveBigFilePartRequest(
+                    file_id, part_index, part_count, part
+                )
+            else:
+                hash_md5.update(part)
+                request = functions.upload.SaveFilePartRequest(
+                    file_id, part_index, part
+                )
+            if not await self.scheduler.call("upload_part", self.client, request):
+                raise RuntimeError(f"Не удалось залить часть {part_index}")
+            part_index += 1
+        if part_index != part_count:
+            raise RuntimeError(
+                f"Залито {part_index} частей из {part_count}, файл неполный"
+            )
+        return is_big, part_count, hash_md5.hexdigest()
+
+    async def transfer(self, message: Message, file_name):
+        """Потоковая перезаливка документа, возвращает готовое InputMedia"""
+        document: Document = message.media.document
+        queue = asyncio.Queue(maxsize=self.buffer_chunks)
+        file_id = int.from_bytes(os.urandom(8), "big", signed=True)
+        download_task = asyncio.create_task(self._download(document, queue))
+        try:
+            is_big, part_count, md5 = await self._upload(
+                file_id, document.size, queue
+            )
+        finally:
+            download_task.cancel()
+            await asyncio.gather(download_task, return_exceptions=True)
+
+        if is_big:
+            input_file = InputFileBig(file_id, part_count, file_name)
+        else:
+            input_file = InputFile(file_id, part_count, file_name, md5)
+        logger.debug(
+            f"Потоково залит {file_name}: {document.size} байт, {part_count} частей"
+        )
+        return uploaded_media(message, input_file)
@@ -0,0 +1,370 @@
+import asyncio
+import itertools
+import time
+from typing import Awaitable, Callable
+
+from loguru import logger
+
+from .metrics import metrics
+from .session_pool import PoolSession, SessionPool
+from .work_unit import PreparedUnit, WorkUnit, message_size
+
+# Приоритеты в общей очереди: новые сообщения обгоняют бэклог
+LIVE_PRIORITY = 0
+BACKLOG_PRIORITY = 1
+# Как часто сохранять замер скорости бэклога, в секундах
+THROUGHPUT_SAMPLE_SECONDS = 60
+# Сколько секунд ответ ждет отправки родителя из другого потока
+REPLY_PARENT_TIMEOUT = 300
+
+
+class Sequencer:
+    """Пропускает этап отправки строго в порядке номеров единиц работы"""
+
+    def __init__(self):
+        self._next = 0
+        self._condition = asyncio.Condition()
+
+    async def wait_turn(self, seq):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._next == seq)
+
+    async def advance(self):
+        async with self._condition:
+            self._next += 1
+            self._condition.notify_all()
+
+
+class _Lane:
+    """Поток единиц работы одного источника и одного приоритета со своим
+    порядком отправки"""
+
+    def __init__(self, priority):
+        self.priority = priority
+        self.sequencer = Sequencer()
+        self._seq = itertools.count()
+
+    def next_seq(self):
+        return next(self._seq)
+
+
+class SyncEngine:
+    """Общая очередь перезаливки для бэклога и новых сообщений.
+
+    Воркеры параллельно скачивают и заливают единицы работы из очереди с
+    приоритетом, а отправляют их в исходном порядке через Sequencer
+    своего потока. Состояние каждой единицы хранится в журнале Database,
+    неудачные повторяются, а после max_attempts уходят в dead_letter.
+    Порядок потоков, ответы на бэклог и повторы описаны в README.
+    """
+
+    def __init__(
+        self,
+        pool: SessionPool,
+        concurrency=4,
+        max_attempts=5,
+        retry_delay=30,
+    ):
+        self.pool = pool
+        self.media_processor = pool.main.media_processor
+        self.db = self.media_processor.db
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        # Повторное получение сообщений источника по ID для новой попытки
+        self.refetch: (
+            Callable[[int, list[int], bool], Awaitable[list[WorkUnit]]] | None
+        ) = None
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self._order = itertools.count()
+        self._lanes: dict[tuple[int, bool], _Lane] = {}
+        # Готовые единицы бэклога ждут своей очереди на отправку, не давая
+        # скану уйти слишком далеко вперед
+        self._backlog_window = asyncio.Semaphore(self.concurrency * 2)
+        self._backlog_pending = 0
+        self._backlog_idle = asyncio.Event()
+        self._backlog_idle.set()
+        # Текущий замер скорости: начало, сообщения и байты
+        self._sample_start = 0.0
+        self._sample_messages = 0
+        self._sample_bytes = 0
+        # (источник, ID сообщения) -> live для сообщений, которые уже в
+        # очереди или в работе
+        self._in_flight: dict[tuple[int, int], bool] = {}
+        # Уведомляется, когда сообщения выходят из _in_flight
+        self._committed = asyncio.Condition()
+        self._workers: list[asyncio.Task] = []
+        self._tasks: set[asyncio.Task] = set()
+        self._stopping = False
+
+    def start(self):
+        if self._workers:
+            return
+        self._stopping = False
+        self._workers = [
+            asyncio.create_task(self._worker())
+            for _ in range(self.concurrency)
+        ]
+
+    async def stop(self):
+        """Остановка воркеров, отправок и повторов до закрытия базы.
+
+        Прерванные единицы работы остаются в журнале без учета попытки и
+        продолжаются после перезапуска.
+        """
+        self._stopping = True
+        tasks = [*self._workers, *self._tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+
+    def is_queued(self, source_chat_id, message_id):
+        return (source_chat_id, message_id) in self._in_flight
+
+    def _lane(self, unit: WorkUnit):
+        key = (unit.source_chat_id, unit.live)
+        lane = self._lanes.get(key)
+        if lane is None:
+            priority = LIVE_PRIORITY if unit.live else BACKLOG_PRIORITY
+            lane = self._lanes[key] = _Lane(priority)
+        return lane
+
+    async def submit(self, unit: WorkUnit):
+        """Постановка единицы работы в очередь.
+
+        Сообщения, уже синхронизированные или уже стоящие в очереди,
+        отбрасываются. Для бэклога вызов ждет, пока освободится окно.
+        """
+        lane = self._lane(unit)
+        if not unit.live:
+            await self._backlog_window.acquire()
+
+        # Проверка после ожидания окна: пока скан ждал, то же сообщение
+        # могло прийти как новое
+        source_chat_id = unit.source_chat_id
+        unit.messages = [
+            message
+            for message in unit.messages
+            if (source_chat_id, message.id) not in self._in_flight
+            and not self.media_processor.is_synced(source_chat_id, message.id)
+        ]
+        if not unit.messages:
+            if not unit.live:
+                self._backlog_window.release()
+            return
+
+        if not unit.live:
+            if not self._backlog_pending:
+                # Время простоя между бэклогами в замер не входит
+                self._sample_start = asyncio.get_running_loop().time()
+            self._backlog_pending += 1
+            self._backlog_idle.clear()
+        self._in_flight.update(
+            ((source_chat_id, message.id), unit.live) for message in unit.messages
+        )
+        # Номер берется до первого await, иначе одновременные вызовы
+        # submit могли бы получить номера не в порядке вызова
+        seq = lane.next_seq()
+        order = next(self._order)
+        try:
+            await self.db.journal_enqueue(
+                source_chat_id,
+                [(message.id, message.grouped_id) for message in unit.messages],
+                live=unit.live,
+                watermark=None if unit.live else unit.last_id,
+            )
+        finally:
+            # Номер уже занят: без единицы работы поток встал бы навсегда
+            await self._queue.put((lane.priority, seq, order, unit))
+            metrics.set_gauge("queue_depth", self._queue.qsize())
+
+    async def join_backlog(self):
+        """Ожидание отправки всего поставленного в очередь бэклога, включая
+        повторные попытки"""
+        await self._backlog_idle.wait()
+
+    async def _worker(self):
+        while True:
+            _, seq, _, unit = await self._queue.get()
+            metrics.set_gauge("queue_depth", self._queue.qsize())
+            if unit.grouped_id:
+                logger.info(
+                    f"Обработка медиагруппы {unit.grouped_id} с сообщениями: {[msg.id for msg in unit.messages]}"
+                )
+            else:
+                logger.info(f"Обработка одиночного медиа с id: {unit.first_id}")
+
+            message_ids = [message.id for message in unit.messages]
+            prepared = None
+            error = "нет медиа для отправки"
+            session = self.pool.acquire()
+            try:
+                await self.db.journal_set_state(
+                    unit.source_chat_id, message_ids, "downloading"
+                )
+                with metrics.timer("prepare"):
+                    prepared = await session.prepare(unit)
+                await self.db.journal_set_state(
+                    unit.source_chat_id, message_ids, "uploaded"
+                )
+            except Exception as e:
+                error = str(e)
+                logger.error(
+                    f"Ошибка при подготовке сообщений {unit.first_id}-{unit.last_id}: {error}"
+                )
+
+            # Отправка ждет своей очереди отдельно, воркер сразу берет
+            # следующую единицу работы
+            self._spawn(self._commit(seq, unit, session, prepared, error))
+
+    def _spawn(self, coro):
+        if self._stopping:
+            coro.close()
+            return
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _commit(
+        self,
+        seq,
+        unit: WorkUnit,
+        session: PoolSession,
+        prepared: PreparedUnit | None,
+        error,
+    ):
+        lane = self._lane(unit)
+        await lane.sequencer.wait_turn(seq)
+        synced_ids = []
+        try:
+            if prepared:
+                await self._wait_reply_parent(unit)
+                with metrics.timer("commit"):
+                    synced_ids = await session.media_processor.commit(prepared)
+                if unit.live:
+                    self._observe_live_latency(unit)
+        except Exception as e:
+            error = str(e)
+            logger.error(
+                f"Ошибка при отправке сообщений {unit.first_id}-{unit.last_id}: {error}"
+            )
+        finally:
+            self.pool.release(session)
+            failed_ids = [
+                message.id
+                for message in unit.messages
+                if message.id not in synced_ids
+            ]
+            if failed_ids:
+                await self._fail(unit.source_chat_id, failed_ids, unit.live, error)
+            for message in unit.messages:
+                self._in_flight.pop((unit.source_chat_id, message.id), None)
+            async with self._committed:
+                self._committed.notify_all()
+            await lane.sequencer.advance()
+            if not unit.live:
+                self._backlog_window.release()
+                self._backlog_pending -= 1
+                await self._sample_throughput(unit, synced_ids)
+                if not self._backlog_pending:
+                    self._backlog_idle.set()
+
+    async def _wait_reply_parent(self, unit: WorkUnit):
+        """Ожидание отправки родителя ответа, стоящего в другом потоке.
+
+        Родитель из того же потока отправлен раньше благодаря Sequencer,
+        а ждать его здесь нельзя: после повторной попытки он может стоять
+        в потоке позже ответа.
+        """
+        parent = (unit.source_chat_id, unit.messages[0].reply_to_msg_id)
+        if self._in_flight.get(parent, unit.live) == unit.live:
+            return
+        try:
+            async with self._committed:
+                await asyncio.wait_for(
+                    self._committed.wait_for(lambda: parent not in self._in_flight),
+                    REPLY_PARENT_TIMEOUT,
+                )
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Сообщение {parent[1]} не отправлено за {REPLY_PARENT_TIMEOUT} с, "
+                f"ответ {unit.first_id} уходит без него"
+            )
+
+    async def _sample_throughput(self, unit: WorkUnit, synced_ids):
+        """Учет отправленной единицы бэклога в замере скорости"""
+        self._sample_messages += len(synced_ids)
+        self._sample_bytes += sum(
+            message_size(message)
+            for message in unit.messages
+            if message.id in synced_ids
+        )
+        now = asyncio.get_running_loop().time()
+        elapsed = now - self._sample_start
+        if elapsed < THROUGHPUT_SAMPLE_SECONDS and self._backlog_pending:
+            return
+        if self._sample_messages:
+            try:
+                await self.db.save_throughput(
+                    elapsed, self._sample_messages, self._sample_bytes
+                )
+            except Exception as e:
+                logger.error(f"Ошибка записи замера скорости: {str(e)}")
+        self._sample_start = now
+        self._sample_messages = 0
+        self._sample_bytes = 0
+
+    async def _fail(self, source_chat_id, message_ids, live, error):
+        """Учет неудачи и планирование повторной попытки"""
+        if self._stopping:
+            return
+        try:
+            dead_ids, attempts = await self.db.journal_fail(
+                source_chat_id, message_ids, error, self.max_attempts
+            )
+        except Exception as e:
+            logger.error(f"Ошибка записи неудачи в журнал: {str(e)}")
+            return
+        if dead_ids:
+            metrics.inc("dead_letters", len(dead_ids))
+            logger.error(
+                f"Сообщения {dead_ids} не удалось перезалить за {self.max_attempts} попыток, перенесены в dead_letter"
+            )
+        retry_ids = [
+            message_id for message_id in message_ids if message_id not in dead_ids
+        ]
+        if retry_ids and self.refetch:
+            if not live:
+                # Бэклог не закончен, пока ждут повторные попытки
+                self._backlog_pending += 1
+                self._backlog_idle.clear()
+            self._spawn(self._retry(source_chat_id, retry_ids, live, attempts))
+
+    async def _retry(self, source_chat_id, message_ids, live, attempts):
+        try:
+            # Пауза растет с каждой неудачной попыткой
+            await asyncio.sleep(self.retry_delay * max(1, attempts))
+            try:
+                units = await self.refetch(source_chat_id, message_ids, live)
+            except Exception as e:
+                logger.error(
+                    f"Не удалось заново получить сообщения {message_ids}: {str(e)}"
+                )
+                return
+            logger.info(f"Повторная попытка для сообщений {message_ids}")
+            for unit in units:
+                await self.submit(unit)
+        finally:
+            if not live:
+                self._backlog_pending -= 1
+                if not self._backlog_pending:
+                    self._backlog_idle.set()
+
+    def _observe_live_latency(self, unit: WorkUnit):
+        """Задержка от публикации в источнике до публикации в назначении"""
+        message = unit.messages[0]
+        if metrics.enabled and self.media_processor.is_synced(
+            unit.source_chat_id, message.id
+        ):
+            metrics.observe("live_latency", time.time() - message.date.timestamp())
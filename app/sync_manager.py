@@ -1,146 +1,633 @@
 import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from functools import partial
 from pathlib import Path
 from typing import cast
 
 from loguru import logger
 from telethon import TelegramClient, events
+from telethon.errors import RPCError
 from telethon.tl.custom.message import Message
-from telethon.tl.types import User
 
+from .album_collector import AlbumCollector
+from .backlog_planner import BacklogPlanner
 from .config import Config
 from .database import Database
 from .media_processor import MediaProcessor
+from .peers import is_user_message
+from .rate_limiter import RateScheduler
+from .session_pool import PoolSession, SessionPool
+from .sync_engine import SyncEngine
+from .work_unit import WorkUnit
+
+# Сколько сообщений каждый диапазон параллельного скана держит в памяти
+# целиком, дальше он запоминает только ID сообщений с медиа
+SCAN_RANGE_BUFFER = 500
+
+
+class _ScanRange:
+    """Результаты одного диапазона параллельного скана по порядку.
+
+    items — сообщения, а после заполнения буфера — ID сообщений с медиа:
+    так диапазон доходит до конца, не дожидаясь, пока до него дойдет
+    очередь, и не держит в памяти все сообщения.
+    """
+
+    def __init__(self):
+        self.items: deque[Message | int] = deque()
+        self.buffered = 0
+        self.done = False
+        self.error: Exception | None = None
+        self.changed = asyncio.Event()
+
+    def add(self, message: Message):
+        if self.buffered < SCAN_RANGE_BUFFER:
+            self.items.append(message)
+            self.buffered += 1
+        elif message.media:
+            self.items.append(message.id)
+        else:
+            return
+        self.changed.set()
+
+    def finish(self, error: Exception | None = None):
+        self.done = True
+        self.error = error
+        self.changed.set()
 
 
 class SyncManager:
+    """Синхронизация всех маршрутов из config.routes.
+
+    Бэклоги источников сканируются одновременно и делят общий SyncEngine,
+    новые сообщения всех источников приходят в один обработчик.
+
+    Сканирует источники и слушает новые сообщения основная сессия client,
+    а передачу файлов она делит с сессиями workers (имя -> клиент).
+    """
+
     def __init__(
         self,
         client: TelegramClient,
         config: Config,
         db: Database,
         temp_dir: Path,
+        scheduler: RateScheduler,
+        workers: dict[str, TelegramClient] | None = None,
     ):
         self.client = client
         self.config = config
         self.db = db
         self.temp_dir = temp_dir
-        self.media_processor = MediaProcessor(client, config, db, temp_dir)
+        self.scheduler = scheduler
+        self.media_processor = MediaProcessor(
+            client, config, db, temp_dir, scheduler
+        )
+        self.pool = SessionPool(
+            PoolSession("main", client, scheduler, self.media_processor, main=True)
+        )
+        for name, worker_client in (workers or {}).items():
+            worker_scheduler = RateScheduler(config.rate_limits, name=name)
+            self.pool.add(
+                PoolSession(
+                    name,
+                    worker_client,
+                    worker_scheduler,
+                    MediaProcessor(
+                        worker_client,
+                        config,
+                        db,
+                        temp_dir,
+                        worker_scheduler,
+                        self.media_processor.file_handler.temp_storage,
+                        self.media_processor.transformer,
+                        worker=name,
+                    ),
+                )
+            )
+        self.sync_engine = SyncEngine(
+            self.pool,
+            config.concurrency,
+            config.max_attempts,
+            config.retry_delay,
+        )
+        self.sync_engine.refetch = self._fetch_units
+        self.peers = self.media_processor.peers
+
+    def _chat_ids(self):
+        chat_ids = set(self.config.routes)
+        for dests in self.config.routes.values():
+            chat_ids.update(dests)
+        return chat_ids
 
-    async def sync_existing_files(self):
-        last_processed_id = self.db.get_last_processed_id(
-            self.config.source_chat_id
+    async def _warm_peers(self):
+        await self.pool.warm(self._chat_ids())
+        await self._seed_dest_ids()
+
+    async def _seed_dest_ids(self):
+        """Последний ID групп назначения, куда бот еще ничего не отправлял.
+
+        Без него dest_max_id в журнале был бы 0, и сверка после падения
+        просматривала бы всю историю группы.
+        """
+        dests = {dest for dests in self.config.routes.values() for dest in dests}
+        for dest_chat_id in dests:
+            if dest_chat_id in self.db.last_dest_message_ids:
+                continue
+            peer = await self.peers.resolve(dest_chat_id)
+            latest = await self.scheduler.call(
+                "scan", self.client.get_messages, peer, limit=1
+            )
+            self.db.note_dest_message_id(
+                dest_chat_id, latest[0].id if latest else 0
+            )
+
+    @asynccontextmanager
+    async def _backlog_client(self):
+        """Клиент для бэклога: takeout-сессия, если она включена и
+        Telegram ее разрешил, иначе обычный клиент"""
+        if not self.config.takeout:
+            yield self.client, "scan"
+            return
+        try:
+            takeout = self.client.takeout(
+                finalize=True,
+                chats=True,
+                megagroups=True,
+                channels=True,
+                files=True,
+                max_file_size=self.config.takeout_max_file_size,
+            )
+            client = await takeout.__aenter__()
+        except (RPCError, ValueError) as e:
+            logger.warning(
+                f"Takeout-сессия недоступна, бэклог идет обычной сессией: {str(e)}"
+            )
+            yield self.client, "scan"
+            return
+        logger.info("Бэклог идет через takeout-сессию")
+        try:
+            yield client, "takeout_scan"
+        except BaseException:
+            takeout.success = False
+            raise
+        finally:
+            await takeout.__aexit__(None, None, None)
+
+    async def sync_existing_files(self, dry_run=False):
+        """Перезаливка бэклога всех источников.
+
+        dry_run — пробный прогон: история сканируется без скачивания, в
+        лог пишется план с оценкой времени (BacklogPlanner), а найденные
+        сообщения сохраняются в индекс скана для настоящего прогона.
+        Возвращает планы источников в пробном прогоне.
+        """
+        if dry_run:
+            return await self._plan_backlog()
+        await self._warm_peers()
+        self.sync_engine.start()
+        # Takeout-сессия нужна до конца бэклога: сообщения, полученные
+        # через нее, через нее же и скачиваются
+        async with self._backlog_client() as (client, scan_op):
+            await asyncio.gather(
+                *(
+                    self._sync_source(source_chat_id, client, scan_op)
+                    for source_chat_id in self.config.routes
+                )
+            )
+            await self.sync_engine.join_backlog()
+        logger.info("Бэклог синхронизирован")
+
+    async def _sync_source(self, source_chat_id, client, scan_op):
+        last_processed_id = await self.db.get_last_processed_id(source_chat_id)
+        logger.info(
+            f"Последнее обработанное сообщение в {source_chat_id}: {last_processed_id}"
         )
-        logger.info(f"Последнее обработанное сообщение: {last_processed_id}")
+        await self._resume_journal(source_chat_id)
+        async for unit in self._scan_units(
+            source_chat_id, last_processed_id, client, scan_op
+        ):
+            await self.sync_engine.submit(unit)
+        # Все из индекса уже в журнале или отправлено
+        await self.db.clear_scan_index(source_chat_id)
 
-        messages_to_process = []
-        grouped_messages = set()
+    async def _plan_backlog(self):
+        # Пробному прогону нужна только основная сессия
+        await self.peers.warm(self._chat_ids())
+        planner = BacklogPlanner(self.media_processor, self.db, self.config)
+        async with self._backlog_client() as (client, scan_op):
+            await asyncio.gather(
+                *(
+                    self._plan_source(planner, source_chat_id, client, scan_op)
+                    for source_chat_id in self.config.routes
+                )
+            )
+        return await planner.report()
 
-        async for message in self.client.iter_messages(
-            self.config.source_chat_id, reverse=True, min_id=last_processed_id
+    async def _plan_source(
+        self, planner: BacklogPlanner, source_chat_id, client, scan_op
+    ):
+        last_processed_id = await self.db.get_last_processed_id(source_chat_id)
+        message_ids = []
+        async for unit in self._scan_units(
+            source_chat_id, last_processed_id, client, scan_op, use_index=False
         ):
+            planner.add(unit)
+            message_ids.extend(message.id for message in unit.messages)
+        await self.db.save_scan_index(source_chat_id, message_ids)
+        logger.info(
+            f"Индекс скана {source_chat_id} сохранен: {len(message_ids)} сообщений"
+        )
+
+    @staticmethod
+    def _group_units(source_chat_id, messages: list[Message], live=False):
+        """Разбиение сообщений на единицы работы по подряд идущим grouped_id"""
+        units = []
+        for message in messages:
+            last = units[-1] if units else None
+            if (
+                last
+                and message.grouped_id
+                and message.grouped_id == last.grouped_id
+            ):
+                last.messages.append(message)
+            else:
+                units.append(
+                    WorkUnit(source_chat_id, [message], message.grouped_id, live)
+                )
+        return units
+
+    async def _fetch_units(self, source_chat_id, message_ids, live=False):
+        """Повторное получение сообщений источника по ID.
+
+        Сообщения, удаленные в источнике, сразу переносятся в dead_letter.
+        """
+        messages = []
+        peer = await self.peers.resolve(source_chat_id)
+        for start in range(0, len(message_ids), 100):
+            chunk = message_ids[start : start + 100]
+            fetched = await self.scheduler.call(
+                "scan",
+                self.client.get_messages,
+                peer,
+                ids=chunk,
+            )
+            missing = []
+            for message_id, message in zip(chunk, fetched):
+                if message is None or not message.media:
+                    missing.append(message_id)
+                else:
+                    messages.append(message)
+            if missing:
+                await self.db.journal_fail(
+                    source_chat_id,
+                    missing,
+                    "сообщение удалено в источнике",
+                    max_attempts=0,
+                )
+                logger.warning(
+                    f"Сообщения {missing} удалены в источнике, перенесены в dead_letter"
+                )
+        return self._group_units(source_chat_id, messages, live)
+
+    async def _reconcile_sending(
+        self, source_chat_id, dest_chat_id, session_name, rows
+    ):
+        """Сверка отправок сессии session_name в dest_chat_id, прерванных
+        падением бота.
+
+        Найденные в группе назначения посты сохраняются как
+        синхронизированные, чтобы не отправить их второй раз. Как посты
+        сопоставляются с журналом, описано в README.
+        """
+        units: dict[int, list] = {}
+        for row in rows:
+            units.setdefault(row[5], []).append(row)
+        min_dest_id = min(row[4] or 0 for row in rows)
+        session = self.pool.get(session_name)
+        if session is None:
+            logger.warning(
+                f"Сессии {session_name} нет в пуле, отправки в {dest_chat_id} сверяются по содержимому"
+            )
+            session = self.pool.main
+        peer = await session.media_processor.peers.resolve(dest_chat_id)
+        synced_ids = await self.db.get_synced_dest_ids(dest_chat_id, min_dest_id)
+
+        def make_iter(last: Message | None):
+            return session.client.iter_messages(
+                peer, reverse=True, min_id=last.id if last else min_dest_id
+            )
+
+        posts: list[list[Message]] = []
+        async for message in session.scheduler.iterate("scan", make_iter):
             message = cast(Message, message)
-            if message.id <= last_processed_id:
+            if message.id in synced_ids:
                 continue
+            if session.name == session_name and not message.out:
+                continue
+            if (
+                posts
+                and message.grouped_id
+                and message.grouped_id == posts[-1][0].grouped_id
+            ):
+                posts[-1].append(message)
+            else:
+                posts.append([message])
 
-            # Сообщения от пользователей не нужны
-            if message.is_private or isinstance(message.sender, User):
+        for send_seq in sorted(units):
+            unit_rows = units[send_seq]
+            dest_max_id = unit_rows[0][4] or 0
+            caption = unit_rows[0][7] or ""
+            album = unit_rows[0][1] is not None
+            match = next(
+                (
+                    index
+                    for index, post in enumerate(posts)
+                    if post[0].id > dest_max_id
+                    and (post[0].text or "") == caption
+                    and bool(post[0].grouped_id) == album
+                    and len(post) == len(unit_rows)
+                ),
+                None,
+            )
+            if match is None:
+                # Отправка не дошла, единица работы уйдет в очередь снова
+                continue
+            post = posts[match]
+            # Более ранние посты не могут принадлежать следующим отправкам
+            del posts[: match + 1]
+            records = [
+                (row[0], sent.id, None) for row, sent in zip(unit_rows, post)
+            ]
+            # Журнал удаляется только после последней группы назначения
+            finished = dest_chat_id == self.config.routes[source_chat_id][-1]
+            await self.db.save_synced(
+                source_chat_id, dest_chat_id, records, finished
+            )
+            logger.info(
+                f"Отправка сообщений {[record[0] for record in records]} подтверждена после перезапуска"
+            )
+
+    async def _resume_journal(self, source_chat_id):
+        """Продолжение незавершенной работы из журнала после перезапуска"""
+        rows = await self.db.get_journal(source_chat_id)
+        if not rows:
+            return
+        logger.info(
+            f"В журнале {source_chat_id} {len(rows)} незавершенных сообщений"
+        )
+
+        sending: dict[tuple[int, str], list] = {}
+        for row in rows:
+            if row[3] == "sending" and row[6] in self.config.routes[source_chat_id]:
+                # Записи до появления пула отправляла основная сессия
+                key = (row[6], row[8] or "main")
+                sending.setdefault(key, []).append(row)
+        for (dest_chat_id, session_name), dest_rows in sending.items():
+            await self._reconcile_sending(
+                source_chat_id, dest_chat_id, session_name, dest_rows
+            )
+
+        for live in (True, False):
+            # Подтвержденные не во все группы назначения сообщения снова
+            # идут в очередь, commit пропустит группы, где они уже есть
+            message_ids = [
+                row[0]
+                for row in rows
+                if bool(row[2]) == live
+                and not self.media_processor.is_synced(source_chat_id, row[0])
+            ]
+            if not message_ids:
+                continue
+            for unit in await self._fetch_units(source_chat_id, message_ids, live):
+                await self.sync_engine.submit(unit)
+
+    def _iter_range(self, client, peer, scan_op, min_id, max_id=None):
+        """Сообщения с ID больше min_id и меньше max_id по возрастанию"""
+
+        def make_iter(last: Message | None):
+            # После FloodWait продолжаем с последнего полученного сообщения
+            return client.iter_messages(
+                peer,
+                reverse=True,
+                min_id=last.id if last else min_id,
+                max_id=max_id or 0,
+            )
+
+        return self.scheduler.iterate(scan_op, make_iter)
+
+    async def _scan_range(
+        self, client, peer, scan_op, min_id, max_id, scan_range: _ScanRange
+    ):
+        try:
+            async for message in self._iter_range(
+                client, peer, scan_op, min_id, max_id
+            ):
+                scan_range.add(message)
+        except Exception as e:
+            scan_range.finish(e)
+        else:
+            scan_range.finish()
+
+    async def _drain_range(self, client, peer, scan_op, scan_range: _ScanRange):
+        """Сообщения диапазона по порядку, запомненные по ID запрашиваются
+        заново пачками по 100"""
+        while True:
+            if not scan_range.items:
+                if scan_range.done:
+                    if scan_range.error:
+                        raise scan_range.error
+                    return
+                scan_range.changed.clear()
+                await scan_range.changed.wait()
                 continue
+            item = scan_range.items.popleft()
+            if not isinstance(item, int):
+                scan_range.buffered -= 1
+                yield item
+                continue
+            ids = [item]
+            while (
+                len(ids) < 100
+                and scan_range.items
+                and isinstance(scan_range.items[0], int)
+            ):
+                ids.append(scan_range.items.popleft())
+            messages = await self.scheduler.call(
+                scan_op, client.get_messages, peer, ids=ids
+            )
+            for message in messages:
+                # Сообщение могли удалить, пока до него дошла очередь
+                if message is not None:
+                    yield message
+
+    async def _scan_messages(self, client, peer, scan_op, last_processed_id):
+        """Сообщения источника после last_processed_id по возрастанию.
+
+        При scan_ranges > 1 интервал от last_processed_id до последнего
+        сообщения делится на столько диапазонов ID, которые сканируются
+        одновременно до конца, а результаты выдаются по порядку: сначала
+        весь первый диапазон, затем второй и так далее. Сверх
+        SCAN_RANGE_BUFFER сообщений диапазон запоминает только ID
+        сообщений с медиа, их сообщения запрашиваются заново, когда до
+        диапазона дойдет очередь.
+        """
+        parts = self.config.scan_ranges
+        latest = None
+        if parts > 1:
+            latest = await self.scheduler.call(
+                scan_op, client.get_messages, peer, limit=1
+            )
+        top_id = latest[0].id if latest else 0
+        if top_id - last_processed_id < parts * SCAN_RANGE_BUFFER:
+            async for message in self._iter_range(
+                client, peer, scan_op, last_processed_id
+            ):
+                yield message
+            return
+
+        step = (top_id - last_processed_id + parts - 1) // parts
+        bounds = [last_processed_id + step * index for index in range(parts)]
+        # Последний диапазон открыт сверху и подхватит новые сообщения
+        ranges = list(zip(bounds, bounds[1:] + [None]))
+        scan_ranges = [_ScanRange() for _ in ranges]
+        tasks = [
+            asyncio.create_task(
+                self._scan_range(
+                    client, peer, scan_op, low, high and high + 1, scan_range
+                )
+            )
+            for (low, high), scan_range in zip(ranges, scan_ranges)
+        ]
+        try:
+            for scan_range in scan_ranges:
+                async for message in self._drain_range(
+                    client, peer, scan_op, scan_range
+                ):
+                    yield message
+        finally:
+            for task in tasks:
+                task.cancel()
 
-            if message.media and not self.db.is_message_synced(message.id):
-                messages_to_process.append(message)
-                if message.grouped_id:
-                    grouped_messages.add(message.id)
+    async def _source_messages(
+        self, source_chat_id, client, peer, scan_op, last_processed_id, use_index
+    ):
+        """Сообщения источника после last_processed_id по возрастанию.
+
+        Если пробный прогон оставил индекс скана, сообщения из него
+        запрашиваются по ID пачками по 100, без страниц с сообщениями без
+        медиа, а сканируется только история после конца индекса.
+        """
+        indexed = []
+        if use_index:
+            indexed = await self.db.get_scan_index(
+                source_chat_id, last_processed_id
+            )
+        if indexed:
+            logger.info(
+                f"Бэклог {source_chat_id} по индексу скана: {len(indexed)} сообщений"
+            )
+            for start in range(0, len(indexed), 100):
+                messages = await self.scheduler.call(
+                    scan_op,
+                    client.get_messages,
+                    peer,
+                    ids=indexed[start : start + 100],
+                )
+                for message in messages:
+                    # Удаленные после пробного прогона сообщения приходят как None
+                    if message is not None:
+                        yield message
+            last_processed_id = indexed[-1]
+        async for message in self._scan_messages(
+            client, peer, scan_op, last_processed_id
+        ):
+            yield message
+
+    async def _scan_units(
+        self, source_chat_id, last_processed_id, client, scan_op, use_index=True
+    ):
+        """Потоковый обход истории источника.
 
-        messages_to_process.sort(key=lambda x: x.id)
+        Медиагруппы собираются на лету из подряд идущих сообщений с одним
+        grouped_id, и каждая готовая единица работы сразу отдается на
+        обработку, поэтому в памяти держится только текущая группа.
+        """
+        media_group: list[Message] = []
+        peer = await self.peers.resolve(source_chat_id)
 
-        processed_groups = set()
-        for message in messages_to_process:
+        async for message in self._source_messages(
+            source_chat_id, client, peer, scan_op, last_processed_id, use_index
+        ):
             message = cast(Message, message)
-            if (
-                message.id in grouped_messages
-                and message.grouped_id not in processed_groups
+            if message.id <= last_processed_id:
+                continue
+
+            # Сообщения от пользователей не нужны
+            if is_user_message(message):
+                continue
+
+            if not message.media or self.media_processor.is_synced(
+                source_chat_id, message.id
             ):
-                media_group = [
-                    msg
-                    for msg in messages_to_process
-                    if msg.grouped_id == message.grouped_id
-                    and msg.id in grouped_messages
-                ]
-                media_group.sort(key=lambda x: x.id)
-                if media_group:
-                    logger.info(
-                        f"Обработка медиагруппы {message.grouped_id} с сообщениями: {[msg.id for msg in media_group]}"
-                    )
-                    await self.media_processor.process_media_group(
-                        media_group,
-                        media_group[0].text or "",
-                        message.grouped_id,
-                    )
-                    processed_groups.add(message.grouped_id)
-            elif message.id not in grouped_messages:
-                logger.info(f"Обработка одиночного медиа с id: {message.id}")
-                await self.media_processor.process_single_media(message)
+                continue
+
+            if media_group and message.grouped_id != media_group[0].grouped_id:
+                yield WorkUnit(source_chat_id, media_group, media_group[0].grouped_id)
+                media_group = []
+
+            if message.grouped_id:
+                media_group.append(message)
+            else:
+                yield WorkUnit(source_chat_id, [message])
+
+        if media_group:
+            yield WorkUnit(source_chat_id, media_group, media_group[0].grouped_id)
+
+    async def _submit_live_album(
+        self, source_chat_id, messages: list[Message], grouped_id
+    ):
+        await self.sync_engine.submit(
+            WorkUnit(source_chat_id, messages, grouped_id, live=True)
+        )
 
     async def monitor_new_files(self):
-        processed_groups = set()
+        """Подписка на новые сообщения.
 
-        @self.client.on(events.NewMessage(chats=self.config.source_chat_id))
+        Новые сообщения идут в общую очередь с приоритетом выше бэклога,
+        поэтому подписку стоит включать до sync_existing_files.
+        """
+        album_collectors = {
+            source_chat_id: AlbumCollector(
+                partial(self._submit_live_album, source_chat_id)
+            )
+            for source_chat_id in self.config.routes
+        }
+        await self._warm_peers()
+        self.sync_engine.start()
+
+        @self.client.on(events.NewMessage(chats=list(self.config.routes)))
         async def handler(event: events.NewMessage):
             message: Message = event.message
+            source_chat_id = event.chat_id
 
             # Пропускаем сообщения, если они не содержат медиа или уже обработаны
-            if not message.media or self.db.is_message_synced(message.id):
+            if (
+                not message.media
+                or source_chat_id not in self.config.routes
+                or self.media_processor.is_synced(source_chat_id, message.id)
+                or self.sync_engine.is_queued(source_chat_id, message.id)
+            ):
                 return
 
             # Проверяем, что сообщение из группы или канала, а не от пользователя
-            if message.is_private or isinstance(message.sender, User):
+            if is_user_message(message):
                 return
 
             if message.grouped_id:
-                if message.grouped_id in processed_groups:
-                    logger.info(
-                        f"Сообщение {message.id} из медиагруппы {message.grouped_id} уже обработано"
-                    )
-                    return
-
-                processed_groups.add(message.grouped_id)
-                try:
-                    media_group = [message]
-                    await asyncio.sleep(2)
-                    async for msg in self.client.iter_messages(
-                        self.config.source_chat_id,
-                        limit=20,
-                        max_id=message.id + 20,
-                        min_id=message.id - 20,
-                    ):
-                        msg = cast(Message, msg)
-                        if (
-                            msg.grouped_id == message.grouped_id
-                            and msg.id != message.id
-                            and msg.media
-                            and not self.db.is_message_synced(msg.id)
-                            and not (
-                                msg.is_private or isinstance(msg.sender, User)
-                            )
-                        ):
-                            media_group.append(msg)
-
-                    media_group.sort(key=lambda x: x.id)
-                    logger.info(
-                        f"Собрано {len(media_group)} сообщений для медиагруппы {message.grouped_id}: {[msg.id for msg in media_group]}"
-                    )
-                    await self.media_processor.process_media_group(
-                        media_group,
-                        media_group[0].text or "",
-                        message.grouped_id,
-                    )
-
-                except Exception as e:
-                    logger.error(
-                        f"Ошибка при обработке новой медиагруппы {message.grouped_id}: {str(e)}"
-                    )
-                finally:
-                    processed_groups.discard(message.grouped_id)
+                album_collectors[source_chat_id].add(message)
             else:
-                logger.info(f"Обработка одиночного медиа с id: {message.id}")
-                await self.media_processor.process_single_media(message)
+                await self.sync_engine.submit(
+                    WorkUnit(source_chat_id, [message], live=True)
+                )
@@ -0,0 +1,95 @@
+import asyncio
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+from loguru import logger
+
+from .metrics import metrics
+
+
+@dataclass
+class TempSlot:
+    """Место под один скачиваемый файл.
+
+    path равен None, если файл маленький и скачивается в память.
+    """
+
+    size: int
+    path: Path | None
+
+
+class TempStorage:
+    """Временные файлы с общим бюджетом байт.
+
+    Каждая задача получает свой уникальный путь, поэтому файлы с
+    одинаковыми именами не мешают друг другу, и удаляет только свои
+    файлы. Пока занятые байты не помещаются в budget, новые скачивания
+    ждут освобождения места. Файлы не больше spool_max_size скачиваются
+    в память и диск не занимают, но в бюджете тоже учитываются.
+
+    Недокачанные .part файлы принадлежат ResumableDownloader: они остаются
+    на диске для докачки, а устаревшие он удаляет сам.
+    """
+
+    def __init__(self, temp_dir: Path, budget, spool_max_size):
+        self.temp_dir = temp_dir
+        self.budget = budget
+        self.spool_max_size = spool_max_size
+        self._used = 0
+        self._released = asyncio.Condition()
+
+    def remove_leftovers(self):
+        """Удаление файлов, оставшихся после падения бота.
+
+        Вызывается при запуске, пока ни одна задача еще не работает.
+        """
+        for file_path in self.temp_dir.glob("*"):
+            # Недокачанные файлы нужны для докачки после перезапуска
+            if file_path.suffix == ".part" or not file_path.is_file():
+                continue
+            try:
+                file_path.unlink()
+                logger.info(f"Удален оставшийся временный файл: {file_path}")
+            except OSError as e:
+                logger.error(f"Ошибка при удалении файла {file_path}: {str(e)}")
+
+    async def _acquire(self, size):
+        async with self._released:
+            # Файл больше всего бюджета пропускаем, когда хранилище пусто,
+            # иначе он ждал бы вечно
+            await self._released.wait_for(
+                lambda: self._used == 0 or self._used + size <= self.budget
+            )
+            self._used += size
+        metrics.set_gauge("temp_bytes", self._used)
+
+    async def _release(self, size):
+        async with self._released:
+            self._used -= size
+            self._released.notify_all()
+        metrics.set_gauge("temp_bytes", self._used)
+
+    def unique_path(self, file_name):
+        # Расширение сохраняем, по нему Telethon определяет тип файла
+        return self.temp_dir / f"{uuid.uuid4().hex}{Path(file_name).suffix}"
+
+    @asynccontextmanager
+    async def reserve(self, size, file_name):
+        """Резервирование места под файл на время скачивания и заливки.
+
+        size — ожидаемый размер в байтах, 0 если неизвестен. При выходе
+        файл слота удаляется, если задача не удалила его сама.
+        """
+        with metrics.timer("temp_wait"):
+            await self._acquire(size)
+        path = None
+        if not size or size > self.spool_max_size:
+            path = self.unique_path(file_name)
+        try:
+            yield TempSlot(size, path)
+        finally:
+            if path is not None:
+                path.unlink(missing_ok=True)
+            await self._release(size)
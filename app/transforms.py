@@ -0,0 +1,285 @@
+import asyncio
+import importlib
+import io
+import multiprocessing
+import shutil
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from loguru import logger
+
+from .metrics import metrics
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow нужен только для перекодирования JPEG
+    Image = None
+
+# Размер превью видео: Telegram принимает JPEG до 320 пикселей
+THUMB_SIZE = 320
+# Ключи настроек преобразования, которые задают фильтр, а не параметры
+FILTER_KEYS = ("mime_types", "min_size", "max_size")
+
+
+@dataclass
+class TransformOutput:
+    """Результат одного преобразования.
+
+    file — новое содержимое файла или None, если файл не изменился,
+    thumb — JPEG превью для документа или None.
+    """
+
+    file: bytes | None = None
+    thumb: bytes | None = None
+
+
+def _read(file: str | bytes):
+    if isinstance(file, bytes):
+        return file
+    return Path(file).read_bytes()
+
+
+def strip_exif(file: str | bytes):
+    """Удаление EXIF и XMP (сегменты APP1) из JPEG без перекодирования"""
+    data = _read(file)
+    if data[:2] != b"\xff\xd8":
+        return None
+    parts = [data[:2]]
+    pos = 2
+    while pos + 4 <= len(data) and data[pos] == 0xFF:
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Байты-заполнители между сегментами
+            pos += 1
+            continue
+        if marker == 0xDA:
+            # Дальше идут сжатые данные изображения
+            break
+        length = int.from_bytes(data[pos + 2 : pos + 4], "big")
+        if marker != 0xE1:
+            parts.append(data[pos : pos + 2 + length])
+        pos += 2 + length
+    parts.append(data[pos:])
+    stripped = b"".join(parts)
+    return TransformOutput(stripped) if len(stripped) < len(data) else None
+
+
+def recompress_jpeg(file: str | bytes, quality=85):
+    """Пересжатие JPEG с заданным качеством через Pillow.
+
+    Поворот из EXIF применяется к пикселям, сами метаданные не
+    сохраняются.
+    """
+    with Image.open(io.BytesIO(_read(file))) as image:
+        image = ImageOps.exif_transpose(image)
+        output = io.BytesIO()
+        image.convert("RGB").save(
+            output, "JPEG", quality=quality, optimize=True, progressive=True
+        )
+    return TransformOutput(output.getvalue())
+
+
+def video_thumb(file: str | bytes, offset=1.0):
+    """Превью видео из кадра на offset секунде через ffmpeg"""
+    source = "pipe:0" if isinstance(file, bytes) else file
+    result = subprocess.run(
+        [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-ss",
+            str(offset),
+            "-i",
+            source,
+            "-frames:v",
+            "1",
+            "-vf",
+            f"scale='min({THUMB_SIZE},iw)':-2",
+            "-f",
+            "mjpeg",
+            "pipe:1",
+        ],
+        input=file if isinstance(file, bytes) else None,
+        capture_output=True,
+        check=True,
+    )
+    return TransformOutput(thumb=result.stdout or None)
+
+
+@dataclass(frozen=True)
+class _Builtin:
+    func: object
+    # Префиксы MIME-типов, к которым применяется преобразование
+    mime_types: tuple[str, ...]
+    requires: str | None = None
+
+
+BUILTIN_TRANSFORMS = {
+    "strip_exif": _Builtin(strip_exif, ("image/jpeg",)),
+    "jpeg": _Builtin(recompress_jpeg, ("image/jpeg",), "Pillow"),
+    "video_thumb": _Builtin(video_thumb, ("video/",), "ffmpeg"),
+}
+
+
+def _resolve(name):
+    """Функция преобразования по имени встроенного или по пути модуль:функция"""
+    builtin = BUILTIN_TRANSFORMS.get(name)
+    if builtin:
+        return builtin.func
+    module_name, _, func_name = name.partition(":")
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+def run_chain(steps: list[tuple[str, dict]], file: str | bytes):
+    """Цепочка преобразований, выполняется в процессе пула.
+
+    Каждое следующее преобразование получает результат предыдущего.
+    Возвращает новое содержимое файла (или None) и превью (или None).
+    """
+    changed = None
+    thumb = None
+    for name, options in steps:
+        output = _resolve(name)(changed or file, **options)
+        if output is None:
+            continue
+        if output.file is not None:
+            changed = output.file
+        if output.thumb is not None:
+            thumb = output.thumb
+    return changed, thumb
+
+
+@dataclass
+class _Step:
+    name: str
+    mime_types: tuple[str, ...]
+    min_size: int = 0
+    max_size: int | None = None
+    options: dict = field(default_factory=dict)
+
+    def matches(self, mime_type, size):
+        if size < self.min_size:
+            return False
+        if self.max_size is not None and size > self.max_size:
+            return False
+        return not self.mime_types or mime_type.startswith(self.mime_types)
+
+
+class MediaTransformer:
+    """Этап преобразования медиа между скачиванием и заливкой.
+
+    Преобразования из config.transforms выполняются по порядку в пуле
+    процессов, чтобы не останавливать цикл событий, одновременно не
+    больше transform_workers файлов. Каждое преобразование применяется
+    только к файлам подходящего MIME-типа и размера. Новое содержимое
+    берется, только если оно меньше исходного, сэкономленные байты
+    попадают в метрику transform_saved_bytes, время — в этап transform.
+
+    Кроме встроенных (BUILTIN_TRANSFORMS) можно подключить свою функцию
+    по пути "модуль:функция". Она получает путь к файлу или его байты и
+    настройки преобразования как именованные аргументы и возвращает
+    TransformOutput или None.
+    """
+
+    def __init__(self, transforms: dict[str, dict], workers=2):
+        self.workers = max(1, workers)
+        self.steps = [
+            step
+            for name, settings in transforms.items()
+            if (step := self._load(name, settings or {}))
+        ]
+        self._limit = asyncio.Semaphore(self.workers)
+        self._executor: ProcessPoolExecutor | None = None
+
+    @staticmethod
+    def _load(name, settings: dict):
+        builtin = BUILTIN_TRANSFORMS.get(name)
+        if builtin is None:
+            try:
+                _resolve(name)
+            except (ImportError, AttributeError, ValueError) as e:
+                logger.error(f"Преобразование {name} не найдено: {str(e)}")
+                return None
+            mime_types = ()
+        else:
+            if builtin.requires == "Pillow" and Image is None:
+                logger.warning(f"Для преобразования {name} нужен Pillow, пропускаем")
+                return None
+            if builtin.requires == "ffmpeg" and not shutil.which("ffmpeg"):
+                logger.warning(f"Для преобразования {name} нужен ffmpeg, пропускаем")
+                return None
+            mime_types = builtin.mime_types
+        return _Step(
+            name,
+            tuple(settings.get("mime_types", mime_types)),
+            settings.get("min_size", 0),
+            settings.get("max_size"),
+            {k: v for k, v in settings.items() if k not in FILTER_KEYS},
+        )
+
+    @property
+    def enabled(self):
+        return bool(self.steps)
+
+    def _pool(self):
+        if self._executor is None:
+            # spawn: fork процесса с потоками базы и логов небезопасен
+            self._executor = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def apply(self, file: Path | bytes, mime_type, file_name):
+        """Преобразование скачанного файла.
+
+        Возвращает файл для заливки (исходный или новое содержимое в
+        байтах) и превью в байтах или None.
+        """
+        size = len(file) if isinstance(file, bytes) else file.stat().st_size
+        steps = [
+            (step.name, step.options)
+            for step in self.steps
+            if step.matches(mime_type or "", size)
+        ]
+        if not steps:
+            return file, None
+
+        payload = file if isinstance(file, bytes) else str(file)
+        loop = asyncio.get_running_loop()
+        async with self._limit:
+            start = time.perf_counter()
+            try:
+                with metrics.timer("transform"):
+                    changed, thumb = await loop.run_in_executor(
+                        self._pool(), run_chain, steps, payload
+                    )
+            except BrokenProcessPool as e:
+                # Процесс пула упал, следующий файл получит новый пул
+                logger.warning(
+                    f"Пул преобразований остановлен на {file_name}: {str(e)}"
+                )
+                self._executor = None
+                return file, None
+            except Exception as e:
+                logger.warning(
+                    f"Ошибка преобразования {file_name}, заливаем как есть: {str(e)}"
+                )
+                return file, None
+            elapsed = time.perf_counter() - start
+
+        if changed is not None and len(changed) < size:
+            metrics.inc("transform_saved_bytes", size - len(changed))
+            logger.info(
+                f"Преобразован {file_name}: {size} -> {len(changed)} байт за {elapsed:.2f} с"
+            )
+            file = changed
+        return file, thumb
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,51 @@
+from dataclasses import dataclass, field
+from typing import Any
+
+from telethon.tl.custom.message import Message
+
+
+def message_size(message: Message):
+    """Размер файла сообщения в байтах, 0 если неизвестен"""
+    return getattr(message.file, "size", None) or 0
+
+
+@dataclass
+class WorkUnit:
+    """Единица работы: одиночное медиа или целая медиагруппа одного источника"""
+
+    source_chat_id: int
+    messages: list[Message]
+    grouped_id: int | None = None
+    # Новое сообщение из NewMessage, а не из бэклога
+    live: bool = False
+
+    @property
+    def first_id(self):
+        return self.messages[0].id
+
+    @property
+    def last_id(self):
+        return self.messages[-1].id
+
+    @property
+    def caption(self):
+        # У медиагруппы подпись хранится в первом сообщении
+        return self.messages[0].text or ""
+
+
+@dataclass
+class PreparedMedia:
+    """Медиа, готовое к отправке в группу назначения"""
+
+    message: Message
+    file_name: str
+    media: Any
+    by_reference: bool = False
+    # SHA-256 скачанного файла, ключ кэша медиа для перезалитых копий
+    content_hash: str | None = None
+
+
+@dataclass
+class PreparedUnit:
+    unit: WorkUnit
+    media: list[PreparedMedia] = field(default_factory=list)
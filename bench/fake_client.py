@@ -0,0 +1,342 @@
+"""Локальная замена TelegramClient для офлайн-бенчмарков.
+
+Имитирует задержку запросов, пропускную способность канала и FloodWait,
+поэтому пропускную способность бота можно измерить без Telegram.
+"""
+
+import asyncio
+import copy
+import itertools
+import os
+import random
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+from telethon import utils
+from telethon.errors import FloodWaitError
+from telethon.tl import functions
+from telethon.tl.types import (
+    Document,
+    DocumentAttributeFilename,
+    InputFile,
+    InputFileBig,
+    InputPeerChannel,
+    InputPeerChat,
+    InputPeerUser,
+    MessageMediaDocument,
+    MessageMediaPhoto,
+    PeerChannel,
+    PeerChat,
+    Photo,
+    PhotoSize,
+)
+
+
+@dataclass
+class FakeNetwork:
+    """Параметры имитируемой сети"""
+
+    latency: float = 0.05
+    # Байт в секунду на одно соединение
+    bandwidth: float = 20 * 1024 * 1024
+    # Вероятность FloodWait на каждый запрос и его длительность
+    flood_rate: float = 0.0
+    flood_seconds: int = 1
+
+    async def request(self, size=0):
+        if self.flood_rate and random.random() < self.flood_rate:
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+        await asyncio.sleep(self.latency + size / self.bandwidth)
+
+
+@dataclass
+class FakeHistory:
+    """Параметры генерируемой истории канала"""
+
+    messages: int = 200
+    # Доля сообщений, входящих в медиагруппы, и размер медиагрупп
+    album_ratio: float = 0.3
+    album_size: int = 4
+    photo_ratio: float = 0.5
+    photo_size: int = 200 * 1024
+    document_size: int = 5 * 1024 * 1024
+    # Доля репостов: медиа с тем же ID, что у одного из прошлых сообщений
+    repost_ratio: float = 0.0
+
+
+class FakeMessage:
+    def __init__(self, client, message_id, media, size, grouped_id=None):
+        self._client = client
+        self.id = message_id
+        self.media = media
+        self.grouped_id = grouped_id
+        # По подписи бенчмарк находит исходное сообщение в send_file
+        self.text = f"#{message_id}"
+        self.reply_to_msg_id = None
+        self.is_private = False
+        self.sender = None
+        self.sender_id = None
+        self.from_id = None
+        self.chat = None
+        self.noforwards = False
+        self.date = datetime.now(timezone.utc)
+        if isinstance(media, MessageMediaPhoto):
+            mime_type = "image/jpeg"
+        else:
+            mime_type = media.document.mime_type
+        self.file = SimpleNamespace(size=size, mime_type=mime_type)
+
+    async def download_media(self, file=None):
+        await self._client.network.request(self.file.size)
+        # Разное содержимое у разных файлов, иначе кэш медиа найдет
+        # совпадение по хэшу у всех файлов одного размера
+        header = _media_id(self.media).to_bytes(8, "little")
+        if file is bytes:
+            return (header + bytes(self.file.size))[: self.file.size]
+        path = Path(file)
+        with open(path, "wb") as f:
+            f.write(header)
+            f.truncate(self.file.size)
+        return str(path)
+
+
+@dataclass
+class FakeEvent:
+    message: FakeMessage
+    chat_id: int
+
+
+def _media_id(media):
+    if isinstance(media, MessageMediaPhoto):
+        return media.photo.id
+    return media.document.id
+
+
+def _make_media(message_id, history: FakeHistory):
+    if random.random() < history.photo_ratio:
+        size = history.photo_size
+        photo = Photo(
+            id=message_id,
+            access_hash=0,
+            file_reference=b"",
+            date=None,
+            sizes=[PhotoSize("y", 1280, 1280, size)],
+            dc_id=2,
+        )
+        return MessageMediaPhoto(photo=photo), size
+    size = history.document_size
+    document = Document(
+        id=message_id,
+        access_hash=0,
+        file_reference=b"",
+        date=None,
+        mime_type="video/mp4",
+        size=size,
+        dc_id=2,
+        attributes=[DocumentAttributeFilename(f"file_{message_id}.mp4")],
+    )
+    return MessageMediaDocument(document=document), size
+
+
+class FakeTelegramClient:
+    """Минимальный набор методов TelegramClient, которые использует бот"""
+
+    def __init__(
+        self, network: FakeNetwork, history: FakeHistory, source_chat_id=-1001
+    ):
+        self.network = network
+        self.source_chat_id = source_chat_id
+        self.handlers = []
+        self.messages: list[FakeMessage] = []
+        self.sent: list[SimpleNamespace] = []
+        # Время отправки в назначение по ID исходного сообщения
+        self.sent_at: dict[int, float] = {}
+        self.total_bytes = 0
+        self._next_id = 1
+        self._dest_ids = itertools.count(1)
+        self._disconnected = asyncio.Event()
+        # Исходная история, которую бот перезаливает как бэклог
+        self.backlog = self.extend_history(history, history.messages)
+        self.backlog_bytes = self.total_bytes
+
+    def extend_history(self, history: FakeHistory, count):
+        new_messages = []
+        while len(new_messages) < count:
+            if random.random() < history.album_ratio:
+                grouped_id = random.getrandbits(62)
+                group_size = min(history.album_size, count - len(new_messages))
+            else:
+                grouped_id = None
+                group_size = 1
+            for _ in range(group_size):
+                if self.messages and random.random() < history.repost_ratio:
+                    original = random.choice(self.messages)
+                    media, size = original.media, original.file.size
+                else:
+                    media, size = _make_media(self._next_id, history)
+                message = FakeMessage(
+                    self, self._next_id, media, size, grouped_id
+                )
+                self._next_id += 1
+                self.total_bytes += size
+                new_messages.append(message)
+                self.messages.append(message)
+        return new_messages
+
+    def session(self, network: FakeNetwork):
+        """Другой аккаунт в тех же чатах со своей сетью и лимитами"""
+        other = copy.copy(self)
+        other.network = network
+        other.handlers = []
+        other._disconnected = asyncio.Event()
+        return other
+
+    def _own(self, message: FakeMessage | None):
+        # Сообщение, полученное этим аккаунтом, качается через его сеть
+        if message is None or message._client is self:
+            return message
+        message = copy.copy(message)
+        message._client = self
+        return message
+
+    @asynccontextmanager
+    async def takeout(self, **kwargs):
+        await self.network.request()
+        yield self
+
+    async def start(self):
+        return self
+
+    async def run_until_disconnected(self):
+        await self._disconnected.wait()
+
+    def disconnect(self):
+        self._disconnected.set()
+
+    def on(self, event):
+        def decorator(handler):
+            self.handlers.append(handler)
+            return handler
+
+        return decorator
+
+    async def emit(self, message: FakeMessage):
+        """Доставка нового сообщения обработчикам NewMessage"""
+        event = FakeEvent(message, self.source_chat_id)
+        await asyncio.gather(*(h(event) for h in self.handlers))
+
+    async def get_input_entity(self, peer):
+        await self.network.request()
+        real_id, peer_class = utils.resolve_id(peer)
+        if peer_class is PeerChannel:
+            return InputPeerChannel(real_id, random.getrandbits(62))
+        if peer_class is PeerChat:
+            return InputPeerChat(real_id)
+        return InputPeerUser(real_id, random.getrandbits(62))
+
+    def _chat_messages(self, entity):
+        if not isinstance(entity, int):
+            entity = utils.get_peer_id(entity)
+        if entity == self.source_chat_id:
+            return self.messages
+        # Из групп назначения отдаются уже отправленные ботом сообщения,
+        # своими (out) аккаунт видит только отправленные им самим
+        return [
+            SimpleNamespace(**{**vars(message), "out": message.sender is self})
+            for message in self.sent
+            if message.chat_id == entity
+        ]
+
+    async def iter_messages(
+        self, entity, reverse=False, min_id=0, max_id=0, limit=None, **kwargs
+    ):
+        messages = self._chat_messages(entity)
+        page = 0
+        for message in messages:
+            if message.id <= min_id:
+                continue
+            if max_id and message.id >= max_id:
+                return
+            if limit is not None and page >= limit:
+                return
+            if page % 100 == 0:
+                await self.network.request()
+            page += 1
+            yield message
+
+    async def get_messages(self, entity, ids=None, limit=None, **kwargs):
+        await self.network.request()
+        messages = self._chat_messages(entity)
+        if ids is None:
+            # Без ids, как и Telethon, отдаем последние сообщения
+            return messages[::-1][:limit]
+        by_id = {message.id: message for message in messages}
+        if not isinstance(ids, list):
+            return self._own(by_id.get(ids))
+        return [self._own(by_id.get(message_id)) for message_id in ids]
+
+    async def iter_download(
+        self, file, offset=0, request_size=512 * 1024, file_size=None, **kwargs
+    ):
+        chunk = bytes(request_size)
+        header = getattr(file, "id", 0).to_bytes(8, "little")
+        while offset < file_size:
+            size = min(request_size, file_size - offset)
+            await self.network.request(size)
+            if offset == 0:
+                yield (header + chunk[8:])[:size]
+            else:
+                yield chunk[:size]
+            offset += size
+
+    async def upload_file(self, file, file_name=None, **kwargs):
+        size = len(file) if isinstance(file, bytes) else os.path.getsize(file)
+        await self.network.request(size)
+        parts = (size + 512 * 1024 - 1) // (512 * 1024)
+        if size > 10 * 1024 * 1024:
+            return InputFileBig(random.getrandbits(62), parts, file_name)
+        return InputFile(random.getrandbits(62), parts, file_name, "")
+
+    async def __call__(self, request):
+        if isinstance(
+            request,
+            (
+                functions.upload.SaveFilePartRequest,
+                functions.upload.SaveBigFilePartRequest,
+            ),
+        ):
+            await self.network.request(len(request.bytes))
+            return True
+        raise NotImplementedError(type(request).__name__)
+
+    async def send_file(
+        self, entity, file, caption="", album=False, reply_to=None, **kwargs
+    ):
+        files = file if isinstance(file, list) else [file]
+        if not isinstance(entity, int):
+            entity = utils.get_peer_id(entity)
+        await self.network.request()
+        loop = asyncio.get_running_loop()
+        source_id = int(caption[1:]) if caption.startswith("#") else None
+        if source_id is not None:
+            self.sent_at[source_id] = loop.time()
+        sent = []
+        grouped_id = random.getrandbits(62) if album else None
+        for index, media in enumerate(files):
+            sent.append(
+                SimpleNamespace(
+                    id=next(self._dest_ids),
+                    chat_id=entity,
+                    sender=self,
+                    out=True,
+                    grouped_id=grouped_id,
+                    media=media,
+                    # Подпись медиагруппы достается первому сообщению
+                    text=caption if index == 0 else "",
+                )
+            )
+        self.sent.extend(sent)
+        return sent if album else sent[0]
@@ -0,0 +1,256 @@
+"""Офлайн-бенчмарк бэклога и перезаливки новых сообщений.
+
+Запуск из корня репозитория:
+
+    python -m bench.run_bench --messages 500 --copy-mode stream
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from loguru import logger
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from .fake_client import FakeHistory, FakeNetwork, FakeTelegramClient
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--live-messages", type=int, default=50)
+    parser.add_argument("--live-interval", type=float, default=0.2)
+    parser.add_argument("--live-timeout", type=float, default=60)
+    parser.add_argument("--album-ratio", type=float, default=0.3)
+    parser.add_argument("--album-size", type=int, default=4)
+    parser.add_argument("--photo-ratio", type=float, default=0.5)
+    parser.add_argument("--photo-size", type=int, default=200 * 1024)
+    parser.add_argument("--document-size", type=int, default=5 * 1024 * 1024)
+    parser.add_argument(
+        "--repost-ratio", type=float, default=0.0, help="доля репостов медиа"
+    )
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument(
+        "--bandwidth", type=float, default=20, help="МБ/с на соединение"
+    )
+    parser.add_argument("--flood-rate", type=float, default=0.0)
+    parser.add_argument("--flood-seconds", type=int, default=1)
+    parser.add_argument("--copy-mode", default="download")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--scan-ranges", type=int, default=1, help="диапазонов параллельного скана"
+    )
+    parser.add_argument("--takeout", action="store_true")
+    parser.add_argument(
+        "--sessions",
+        type=int,
+        default=0,
+        help="дополнительных аккаунтов, у каждого своя сеть и лимиты",
+    )
+    parser.add_argument(
+        "--destinations",
+        type=int,
+        default=1,
+        help="в сколько групп назначения копировать источник",
+    )
+    parser.add_argument(
+        "--send-rate", type=float, default=None, help="лимит send, запросов/с"
+    )
+    parser.add_argument(
+        "--live-during-backlog",
+        action="store_true",
+        help="слать новые сообщения, пока идет бэклог",
+    )
+    parser.add_argument(
+        "--retry-delay", type=int, default=1, help="retry_delay бота, секунд"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return float("nan")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # На macOS ru_maxrss в байтах, на Linux в килобайтах
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def _percentile(values, percent):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(len(values) - 1, round(percent / 100 * (len(values) - 1)))
+    return values[index]
+
+
+def _write_config(args):
+    config = {
+        "api_id": 1,
+        "api_hash": "bench",
+        "routes": [
+            {
+                "source": -1001,
+                "dest": [-1002 - index for index in range(args.destinations)],
+            }
+        ],
+        "copy_mode": args.copy_mode,
+        "concurrency": args.concurrency,
+        "scan_ranges": args.scan_ranges,
+        "takeout": args.takeout,
+        "retry_delay": args.retry_delay,
+    }
+    if args.send_rate:
+        config["rate_limits"] = {"send": args.send_rate}
+    Path("config.json").write_text(json.dumps(config))
+
+
+async def _run_backlog(bot, client: FakeTelegramClient):
+    start = time.perf_counter()
+    # Возвращается, когда все сообщения отправлены или ушли в dead_letter
+    await bot.sync_manager.sync_existing_files()
+    elapsed = time.perf_counter() - start
+    # Скорость считается только по сообщениям, дошедшим во все группы
+    # назначения
+    sent = [
+        message
+        for message in client.backlog
+        if bot.sync_manager.media_processor.is_synced(
+            client.source_chat_id, message.id
+        )
+    ]
+    sent_bytes = sum(message.file.size for message in sent)
+    return {
+        "messages": len(client.backlog),
+        "sent": len(sent),
+        "failed": len(client.backlog) - len(sent),
+        "seconds": elapsed,
+        "messages_per_sec": len(sent) / elapsed,
+        "mb_per_sec": sent_bytes / elapsed / 1024 / 1024,
+    }
+
+
+async def _run_live(client: FakeTelegramClient, history, args):
+    loop = asyncio.get_running_loop()
+    emitted_at = {}
+    seen_groups = set()
+    tasks = []
+    new_messages = client.extend_history(history, args.live_messages)
+    for message in new_messages:
+        # Задержка медиагруппы считается по первому сообщению, только у
+        # него есть подпись, по которой фейковый send_file узнает источник
+        if message.grouped_id is None or message.grouped_id not in seen_groups:
+            emitted_at[message.id] = loop.time()
+            seen_groups.add(message.grouped_id)
+        # Как и Telethon, обработчики событий не блокируют прием новых
+        tasks.append(asyncio.create_task(client.emit(message)))
+        await asyncio.sleep(args.live_interval)
+    await asyncio.gather(*tasks)
+    # Ждем, пока отправятся все сообщения и медиагруппы, включая окно сборки
+    # последней медиагруппы и повторы после ошибок
+    deadline = loop.time() + args.live_timeout
+    while loop.time() < deadline and not emitted_at.keys() <= client.sent_at.keys():
+        await asyncio.sleep(0.05)
+
+    # Не отправленные за отведенное время считаются с задержкой до дедлайна,
+    # чтобы медленные отправки не выпадали из перцентилей
+    latencies = [
+        client.sent_at.get(message_id, deadline) - emitted
+        for message_id, emitted in emitted_at.items()
+    ]
+    sent = sum(message_id in client.sent_at for message_id in emitted_at)
+    return {
+        "units": len(emitted_at),
+        "sent": sent,
+        "failed": len(emitted_at) - sent,
+        "p50_latency": _percentile(latencies, 50),
+        "p99_latency": _percentile(latencies, 99),
+    }
+
+
+async def _main(args):
+    import random
+
+    random.seed(args.seed)
+    # Бот импортируется только здесь: при импорте он настраивает логи в cwd
+    from app.bot import CopycatBot
+    from app.config import Config
+    from app.database import Database
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    network = FakeNetwork(
+        latency=args.latency,
+        bandwidth=args.bandwidth * 1024 * 1024,
+        flood_rate=args.flood_rate,
+        flood_seconds=args.flood_seconds,
+    )
+    history = FakeHistory(
+        messages=args.messages,
+        album_ratio=args.album_ratio,
+        album_size=args.album_size,
+        photo_ratio=args.photo_ratio,
+        photo_size=args.photo_size,
+        document_size=args.document_size,
+        repost_ratio=args.repost_ratio,
+    )
+    client = FakeTelegramClient(network, history)
+    workers = {
+        f"worker{index}": client.session(copy.copy(network))
+        for index in range(args.sessions)
+    }
+    _write_config(args)
+    bot = CopycatBot(Config(), client, Database("bench.db"), workers)
+
+    try:
+        await bot.sync_manager.monitor_new_files()
+        if args.live_during_backlog:
+            backlog, live = await asyncio.gather(
+                _run_backlog(bot, client), _run_live(client, history, args)
+            )
+        else:
+            backlog = await _run_backlog(bot, client)
+            live = await _run_live(client, history, args)
+    finally:
+        await bot.sync_manager.sync_engine.stop()
+        await bot.db.close()
+
+    print(
+        f"Бэклог: отправлено {backlog['sent']} из {backlog['messages']} сообщений "
+        f"за {backlog['seconds']:.2f} с, не удалось {backlog['failed']}, "
+        f"{backlog['messages_per_sec']:.1f} сообщ/с, {backlog['mb_per_sec']:.1f} МБ/с"
+    )
+    print(
+        f"Новые: отправлено {live['sent']} из {live['units']} сообщений и медиагрупп, "
+        f"не дождались {live['failed']}, "
+        f"p50 {live['p50_latency'] * 1000:.0f} мс, p99 {live['p99_latency'] * 1000:.0f} мс"
+    )
+    print(f"Пиковый RSS: {_peak_rss_mb():.1f} МБ")
+
+
+def main():
+    args = _parse_args()
+    root = Path.cwd()
+    with tempfile.TemporaryDirectory(prefix="copycat-bench-") as workdir:
+        sys.path.insert(0, str(root))
+        os.chdir(workdir)
+        Path("temp").mkdir()
+        try:
+            asyncio.run(_main(args))
+        finally:
+            os.chdir(root)
+
+
+if __name__ == "__main__":
+    main()